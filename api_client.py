@@ -0,0 +1,93 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
+
+API_URL = "http://127.0.0.1:8000"
+# (connect, read) seconds
+REQUEST_TIMEOUT = (3.05, 15)
+MAX_WORKERS = 4
+
+
+class RequestSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    done = pyqtSignal(object)
+
+
+class RequestWorker(QRunnable):
+    def __init__(self, client, method, path, kwargs):
+        super().__init__()
+        self.client = client
+        self.method = method
+        self.path = path
+        self.kwargs = kwargs
+        self.signals = RequestSignals()
+
+    def run(self):
+        try:
+            response = self.client.request(self.method, self.path, **self.kwargs)
+        except requests.RequestException as error:
+            self.signals.failed.emit(str(error))
+        else:
+            self.signals.finished.emit(response)
+        finally:
+            self.signals.done.emit(self)
+
+
+class ApiClient(QObject):
+    # One keep-alive session for the whole application. Requests run on a
+    # small thread pool and their results come back to the GUI thread through
+    # Qt signals, so handlers never block the window.
+
+    def __init__(self, base_url=API_URL):
+        super().__init__()
+        self.base_url = base_url
+        self.token = None
+
+        # Only idempotent requests are retried; a repeated POST could book or
+        # pay twice.
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET"}), respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(MAX_WORKERS)
+        self.workers = set()
+
+    def request(self, method, path, headers=None, **kwargs):
+        headers = dict(headers or {})
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return self.session.request(
+            method, f"{self.base_url}{path}", headers=headers, timeout=REQUEST_TIMEOUT, **kwargs)
+
+    def submit(self, method, path, on_finished, on_failed=None, **kwargs):
+        # on_finished receives the requests.Response, on_failed the error text
+        # when the server could not be reached. Both should be bound methods of
+        # widgets so that Qt delivers them on the GUI thread.
+        worker = RequestWorker(self, method, path, kwargs)
+        worker.signals.finished.connect(on_finished)
+        if on_failed:
+            worker.signals.failed.connect(on_failed)
+        worker.signals.done.connect(self.release)
+        self.workers.add(worker)
+        self.pool.start(worker)
+        return worker
+
+    def get(self, path, on_finished, on_failed=None, **kwargs):
+        return self.submit("GET", path, on_finished, on_failed, **kwargs)
+
+    def post(self, path, on_finished, on_failed=None, **kwargs):
+        return self.submit("POST", path, on_finished, on_failed, **kwargs)
+
+    @pyqtSlot(object)
+    def release(self, worker):
+        self.workers.discard(worker)
+
+    def close(self):
+        self.pool.waitForDone()
+        self.session.close()
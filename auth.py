@@ -1,28 +1,47 @@
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import HTTPException, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.security import OAuth2PasswordBearer
+from cache import TTLCache
+from hashing import hash_password, verify_password
+import os
+import time
 import database
+import hashing
 import models
 
-with open("venv/secret_key.txt", "r") as f:
-    SECRET_KEY = f.read().strip()
-
+# Loaded by init_secrets() when the app starts.
+SECRET_KEY = None
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
-pwd_context = CryptContext(
-    schemes=["bcrypt"], deprecated="auto", bcrypt__ident="2b")
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+
+# token -> username, and username -> column snapshot of the user row
+token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+USER_CACHE_FIELDS = ("id", "username", "email", "role")
+
 
+def init_secrets(settings):
+    global SECRET_KEY
+    if settings.secret_key:
+        SECRET_KEY = settings.secret_key
+    else:
+        with open(settings.secret_key_file, "r") as f:
+            SECRET_KEY = f.read().strip()
+    token_cache.clear()
 
-def hash_password(password: str):
-    return pwd_context.hash(password)
 
+async def hash_password_async(password: str):
+    return await hashing.hasher.run(hash_password, password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await hashing.hasher.run(verify_password, plain_password, hashed_password)
 
 
 def create_access_token(data: dict):
@@ -32,29 +51,74 @@ def create_access_token(data: dict):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user_by_username(db, username)
-    if not user or not verify_password(password, user.password_hash):
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user_by_username(db, username)
+    if not user or not await verify_password_async(password, user.password_hash):
         return None
     return user
 
 
+async def get_cached_user(db: AsyncSession, username: str):
+    snapshot = user_cache.get(username)
+    if snapshot is not None:
+        return models.User(**snapshot)
+
+    user = await get_user_by_username(db, username)
+    if user:
+        user_cache.set(username, {field: getattr(user, field)
+                       for field in USER_CACHE_FIELDS})
+    return user
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(target.username)
+    for old_username in inspect(target).attrs.username.history.deleted:
+        user_cache.pop(old_username)
+
+
+def cache_stats():
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+def token_subject(token: str):
+    # Username the token was issued to, or None if it is invalid or expired.
+    username = token_cache.get(token)
+    if username is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
         username = payload.get("sub")
         if not username:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = get_user_by_username(db, username)
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except JWTError:
+            return None
+        # A cached token must never outlive its own expiry.
+        token_cache.set(token, username, ttl=min(
+            AUTH_CACHE_TTL, payload["exp"] - time.time()))
+    return username
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_db)):
+    username = token_subject(token)
+    if username is None:
         raise HTTPException(status_code=401, detail="Invalid token")
+
+    user = await get_cached_user(db, username)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+
+async def get_current_admin(user: models.User = Depends(get_current_user)):
+    if user.role != models.UserRole.admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
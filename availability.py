@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+from sqlalchemy import exists, insert, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+
+
+def naive_utc(value: datetime):
+    # Booking dates are stored as naive UTC; aware input is converted to
+    # match, so it can be compared with what comes back from the database.
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def overlaps(place_id: int, start: datetime, end: datetime):
+    # Served by the partial (place_id, end_date) index: historical bookings
+    # that ended before `start` are never visited.
+    return (
+        models.Booking.place_id == place_id,
+        models.Booking.status != models.BookingStatus.canceled,
+        models.Booking.end_date > start,
+        models.Booking.start_date < end,
+    )
+
+
+async def book(db: AsyncSession, user_id: int, place_id: int, start: datetime, end: datetime):
+    # Checks the place, checks for overlaps and inserts in one
+    # INSERT ... SELECT ... RETURNING; returns the new id, or None when the
+    # place is missing or taken. The overlap check reads the statement's
+    # snapshot, so on Postgres two concurrent bookings can both pass it; the
+    # exclusion constraint rejects the second (IntegrityError). SQLite runs
+    # one writer at a time.
+    source = select(
+        literal(user_id, models.Booking.user_id.type),
+        models.Place.id,
+        literal(start, models.Booking.start_date.type),
+        literal(end, models.Booking.end_date.type),
+        literal(models.BookingStatus.pending, models.Booking.status.type),
+    ).where(
+        models.Place.id == place_id,
+        ~exists().where(*overlaps(place_id, start, end)),
+    )
+    result = await db.execute(insert(models.Booking).from_select(
+        ["user_id", "place_id", "start_date", "end_date", "status"], source).returning(models.Booking.id))
+    return result.scalar()
+
+
+async def free_windows(db: AsyncSession, place_id: int, start: datetime, end: datetime):
+    result = await db.execute(select(models.Booking.start_date, models.Booking.end_date).where(
+        *overlaps(place_id, start, end)).order_by(models.Booking.start_date))
+
+    windows = []
+    cursor = start
+    for busy_start, busy_end in result:
+        if busy_start > cursor:
+            windows.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    if cursor < end:
+        windows.append((cursor, end))
+    return windows
+
+
+async def check_batch(db: AsyncSession, items):
+    # Returns one error (or None) per item. Every place is locked and every
+    # live booking that could clash is read with a single query each; items
+    # are then checked against those and against earlier items of the batch.
+    errors = [None] * len(items)
+    periods = [(naive_utc(item.start_date), naive_utc(item.end_date)) for item in items]
+    place_ids = {item.place_id for item in items}
+    result = await db.execute(select(models.Place.id).where(
+        models.Place.id.in_(place_ids)).order_by(models.Place.id).with_for_update())
+    existing = set(result.scalars())
+
+    start = min(item_start for item_start, _ in periods)
+    end = max(item_end for _, item_end in periods)
+    result = await db.execute(select(
+        models.Booking.place_id, models.Booking.start_date, models.Booking.end_date).where(
+        models.Booking.place_id.in_(existing),
+        models.Booking.status != models.BookingStatus.canceled,
+        models.Booking.end_date > start,
+        models.Booking.start_date < end,
+    ))
+    busy = {}
+    for place_id, busy_start, busy_end in result:
+        busy.setdefault(place_id, []).append((busy_start, busy_end))
+
+    for index, (item, (item_start, item_end)) in enumerate(zip(items, periods)):
+        if item_end <= item_start:
+            errors[index] = "Invalid booking period"
+        elif item.place_id not in existing:
+            errors[index] = "Place not found"
+        elif any(busy_start < item_end and busy_end > item_start
+                 for busy_start, busy_end in busy.get(item.place_id, ())):
+            errors[index] = "Place is already booked for these dates"
+        else:
+            busy.setdefault(item.place_id, []).append((item_start, item_end))
+    return errors
@@ -0,0 +1,370 @@
+# Load-test and benchmark suite for the API.
+#
+#   python bench.py --concurrency 32 --operations 2000 --output bench.json
+#   python bench.py --compare bench.json --output bench-new.json
+#
+# The app is driven in-process over ASGI against a throwaway SQLite database
+# (or --database-url, whose tables are dropped: requires --reset-database),
+# seeded with --users/--places/--bookings/--reviews rows.
+# SQL statements are counted by the app's own metrics hooks, so the report
+# has latency percentiles, throughput and query counts against each route's
+# budget; --strict-budgets aborts on the first request over budget.
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_PASSWORD = "bench-password"
+PLACE_TYPES = ("apartment", "house", "room", "hostel", "villa")
+LOCATIONS = ("Moscow", "Kazan", "Sochi", "Saint Petersburg", "Novosibirsk", "Yekaterinburg")
+SEED_CHUNK = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the booking API")
+    parser.add_argument("--database-url", help="database to seed and run against (default: temporary SQLite file)")
+    parser.add_argument("--reset-database", action="store_true",
+                        help="allow dropping every table of --database-url before seeding")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--places", type=int, default=5000)
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--reviews", type=int, default=20000)
+    parser.add_argument("--scenarios", default="browse,login,booking,mixed",
+                        help="comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--operations", type=int, default=1000, help="operations per scenario")
+    parser.add_argument("--login-operations", type=int, default=100,
+                        help="operations for the login scenario (bcrypt bound)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="previous JSON report to print deltas against")
+    parser.add_argument("--strict-budgets", action="store_true",
+                        help="abort when a request goes over its route's query budget")
+    return parser.parse_args()
+
+
+def bench_settings(args, workdir):
+    from settings import Settings
+
+    return Settings(
+        database_url=args.database_url or f"sqlite+aiosqlite:///{workdir}/bench.db",
+        pool_warmup=min(args.concurrency, 5),
+        # startup needs the schema; seed() then rebuilds it from scratch
+        create_tables=True,
+        secret_key=os.urandom(32).hex(),
+    )
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, endpoint, seconds, queries, status, ok):
+        samples = self.samples.setdefault(endpoint, {"seconds": [], "queries": [], "statuses": {}, "errors": 0})
+        samples["seconds"].append(seconds)
+        samples["queries"].append(queries)
+        samples["statuses"][str(status)] = samples["statuses"].get(str(status), 0) + 1
+        if not ok:
+            samples["errors"] += 1
+
+    def summary(self, elapsed, budgets):
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            seconds = samples["seconds"]
+            budget = budgets.get(tuple(endpoint.split(" ", 1)))
+            endpoints[endpoint] = {
+                "count": len(seconds),
+                "errors": samples["errors"],
+                "statuses": samples["statuses"],
+                "throughput_rps": round(len(seconds) / elapsed, 2),
+                "p50_ms": round(percentile(seconds, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(seconds, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(seconds, 0.99) * 1000, 3),
+                "queries_mean": round(sum(samples["queries"]) / len(seconds), 2),
+                "queries_max": max(samples["queries"]),
+                "query_budget": budget,
+                "over_budget": sum(1 for queries in samples["queries"] if budget is not None and queries > budget),
+            }
+        total = sum(endpoint["count"] for endpoint in endpoints.values())
+        return {
+            "duration_s": round(elapsed, 3),
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 2),
+            "endpoints": endpoints,
+        }
+
+
+class CountQueries:
+    # ASGI wrapper that reports the statements counted by the app's metrics
+    # hooks, with the matched route template, in response headers.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        import metrics
+
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        with metrics.track_request() as stats:
+            async def send_with_counts(message):
+                if message["type"] == "http.response.start":
+                    route = scope.get("route")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-bench-queries", str(stats.queries).encode()))
+                    headers.append((b"x-bench-route", getattr(route, "path", scope["path"]).encode()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_counts)
+
+
+async def seed(args, rng):
+    from sqlalchemy import insert, text
+    import auth
+    import database
+    import models
+    import ratings
+    import rollups
+
+    async with database.engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            await conn.execute(text("PRAGMA journal_mode=WAL"))
+        await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(models.Base.metadata.create_all)
+
+    password_hash = auth.hash_password(BENCH_PASSWORD)
+    users = [{"username": f"user{i}", "email": f"user{i}@example.com", "password_hash": password_hash,
+              "role": models.UserRole.user} for i in range(args.users)]
+    places = [{"name": f"{rng.choice(PLACE_TYPES).title()} #{i}", "type": rng.choice(PLACE_TYPES),
+               "location": rng.choice(LOCATIONS), "description": f"Benchmark place {i}",
+               "price_per_day": round(rng.uniform(20, 400), 2)} for i in range(args.places)]
+
+    # Historical bookings, back to back per place so they never overlap.
+    bookings = []
+    per_place = max(1, args.bookings // max(1, args.places))
+    now = datetime.utcnow()
+    for place_id in range(1, args.places + 1):
+        end = now - timedelta(days=rng.randint(1, 30))
+        for _ in range(per_place):
+            if len(bookings) >= args.bookings:
+                break
+            start = end - timedelta(days=rng.randint(1, 7))
+            bookings.append({"user_id": rng.randint(1, args.users), "place_id": place_id,
+                             "start_date": start, "end_date": end,
+                             "status": rng.choice(list(models.BookingStatus))})
+            end = start - timedelta(days=rng.randint(0, 5))
+
+    reviews = [{"user_id": rng.randint(1, args.users), "place_id": rng.randint(1, args.places),
+                "rating": rng.randint(1, 5), "comment": "Benchmark review",
+                "created_at": now - timedelta(minutes=rng.randint(1, 500000))} for _ in range(args.reviews)]
+
+    async with database.engine.begin() as conn:
+        for model, rows in ((models.User, users), (models.Place, places),
+                            (models.Booking, bookings), (models.Review, reviews)):
+            for offset in range(0, len(rows), SEED_CHUNK):
+                await conn.execute(insert(model), rows[offset:offset + SEED_CHUNK])
+    async with database.SessionLocal() as db:
+        await ratings.rebuild(db)
+        await rollups.rebuild(db)
+        await db.commit()
+
+
+class Workload:
+    def __init__(self, client, recorder, rng, args, tokens):
+        self.client = client
+        self.recorder = recorder
+        self.rng = rng
+        self.args = args
+        self.tokens = tokens
+
+    async def call(self, method, url, expected=(200,), token=None, **kwargs):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        started = time.perf_counter()
+        response = await self.client.request(method, url, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - started
+        route = response.headers.get("x-bench-route", url)
+        self.recorder.add(f"{method} {route}", elapsed, int(response.headers.get("x-bench-queries", 0)),
+                          response.status_code, response.status_code in expected)
+        return response
+
+    def place_id(self):
+        return self.rng.randint(1, self.args.places)
+
+    async def browse(self):
+        roll = self.rng.random()
+        if roll < 0.4:
+            params = {"limit": 50}
+            if self.rng.random() < 0.5:
+                params["type"] = self.rng.choice(PLACE_TYPES)
+            if self.rng.random() < 0.3:
+                params["location"] = self.rng.choice(LOCATIONS)
+            if self.rng.random() < 0.5:
+                params["cursor"] = str(self.rng.randint(0, self.args.places))
+            await self.call("GET", "/places/", params=params)
+        elif roll < 0.5:
+            term = self.rng.choice(PLACE_TYPES + LOCATIONS)
+            await self.call("GET", "/places/search", params={"q": term[:self.rng.randint(3, len(term))]})
+        elif roll < 0.65:
+            await self.call("GET", f"/places/{self.place_id()}")
+        elif roll < 0.82:
+            await self.call("GET", f"/reviews/{self.place_id()}")
+        else:
+            start = datetime.utcnow() + timedelta(days=self.rng.randint(0, 60))
+            await self.call("GET", f"/places/{self.place_id()}/availability", params={
+                "from": start.isoformat(), "to": (start + timedelta(days=30)).isoformat()})
+
+    async def login(self):
+        user = self.rng.randint(0, self.args.users - 1)
+        # 503 is the hasher shedding load, which is the behaviour under test.
+        await self.call("POST", "/login/", expected=(200, 503),
+                        json={"username": f"user{user}", "password": BENCH_PASSWORD})
+
+    async def booking(self):
+        token = self.rng.choice(self.tokens)
+        start = datetime.utcnow() + timedelta(days=self.rng.randint(1, 365))
+        response = await self.call("POST", "/book/", expected=(200, 409), token=token, json={
+            "place_id": self.place_id(), "start_date": start.isoformat(),
+            "end_date": (start + timedelta(days=self.rng.randint(1, 7))).isoformat()})
+        if response.status_code != 200:
+            return
+        booking_id = response.json()["booking_id"]
+        await self.call("GET", "/my_bookings/", token=token)
+        await self.call("POST", "/pay/", expected=(200, 202, 409), token=token,
+                        json={"booking_id": booking_id, "amount": 100.0})
+        if self.rng.random() < 0.3:
+            await self.call("POST", f"/cancel_booking/{booking_id}", expected=(200, 409), token=token)
+
+    async def review(self):
+        await self.call("POST", "/review/", expected=(200, 202), token=self.rng.choice(self.tokens), json={
+            "place_id": self.place_id(), "rating": self.rng.randint(1, 5), "comment": "Benchmark review"})
+
+    async def mixed(self):
+        roll = self.rng.random()
+        if roll < 0.7:
+            await self.browse()
+        elif roll < 0.9:
+            await self.booking()
+        elif roll < 0.95:
+            await self.review()
+        else:
+            await self.login()
+
+
+SCENARIOS = ("browse", "login", "booking", "review", "mixed")
+
+
+async def run_scenario(name, app, args, rng, tokens):
+    import httpx
+    import metrics
+
+    recorder = Recorder()
+    operations = args.login_operations if name == "login" else args.operations
+    remaining = iter(range(operations))
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        workload = Workload(client, recorder, random.Random(rng.random()), args, tokens)
+        operation = getattr(workload, name)
+
+        async def worker():
+            for _ in remaining:
+                await operation()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+    return recorder.summary(elapsed, metrics.registry.budgets)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(previous, current):
+    for name, scenario in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        print(f"{name}: {before['throughput_rps']} -> {scenario['throughput_rps']} req/s", file=sys.stderr)
+        for endpoint, stats in scenario["endpoints"].items():
+            old = before["endpoints"].get(endpoint)
+            if not old:
+                continue
+            change = (stats["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100 if old["p95_ms"] else 0.0
+            print(f"  {endpoint}: p95 {old['p95_ms']} -> {stats['p95_ms']} ms ({change:+.1f}%), "
+                  f"queries {old['queries_mean']} -> {stats['queries_mean']}", file=sys.stderr)
+
+
+async def main():
+    args = parse_args()
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.database_url and not args.reset_database:
+        raise SystemExit("Seeding drops every table of --database-url; pass --reset-database to confirm")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # every simulated client shares one address; throttling would skew the numbers
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+        if args.strict_budgets:
+            # read when metrics is first imported
+            os.environ["QUERY_BUDGET_STRICT"] = "1"
+        import auth
+        import database
+        import main as api
+
+        api_app = api.create_app(bench_settings(args, workdir))
+        app = CountQueries(api_app)
+
+        report = {
+            "meta": {
+                "revision": git_revision(),
+                "timestamp": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "concurrency": args.concurrency,
+                "operations": args.operations,
+                "seed": {"users": args.users, "places": args.places,
+                         "bookings": args.bookings, "reviews": args.reviews},
+            },
+            "scenarios": {},
+        }
+        async with api_app.router.lifespan_context(api_app):
+            rng = random.Random(args.seed)
+            await seed(args, rng)
+            tokens = [auth.create_access_token({"sub": f"user{i}"}) for i in range(args.users)]
+            report["meta"]["database"] = database.engine.dialect.name
+            for name in scenarios:
+                report["scenarios"][name] = await run_scenario(name, app, args, rng, tokens)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
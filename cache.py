@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    # LRU-bounded mapping whose entries also expire after a TTL. Guarded by a
+    # lock so it can be shared with worker threads.
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING or item[1] <= time.monotonic():
+                if item is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class MemoryBackend:
+    # Per-process generation counters. Enough for a single worker, and the
+    # stand-in for a shared backend in tests.
+
+    def __init__(self):
+        self._generations = {}
+
+    async def generation(self, namespace: str):
+        return self._generations.get(namespace, 0)
+
+    async def bump(self, namespace: str):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+
+class RedisBackend:
+    # Generation counters shared through Redis, so an invalidation in one
+    # worker retires the cached entries of every worker.
+
+    def __init__(self, url: str, prefix: str = "cache-generation:"):
+        import redis.asyncio
+        self._client = redis.asyncio.Redis.from_url(url)
+        self._prefix = prefix
+
+    async def generation(self, namespace: str):
+        return int(await self._client.get(self._prefix + namespace) or 0)
+
+    async def bump(self, namespace: str):
+        await self._client.incr(self._prefix + namespace)
+
+
+class ResponseCache:
+    # Entries are keyed by (namespace, generation, key). Invalidating a
+    # namespace bumps its generation, and the old entries are never hit again
+    # and age out of the LRU.
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0, backend=None):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.backend = backend or MemoryBackend()
+
+    async def lookup(self, namespace: str, key):
+        # The generation is read before the caller builds the value, so a
+        # write racing with the build can only orphan the entry, never leave
+        # it stale.
+        cache_key = (namespace, await self.backend.generation(namespace), key)
+        return cache_key, self.entries.get(cache_key)
+
+    def store(self, cache_key, value):
+        self.entries.set(cache_key, value)
+
+    async def invalidate(self, *namespaces: str):
+        for namespace in namespaces:
+            await self.backend.bump(namespace)
+
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "30"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+
+place_cache = ResponseCache(
+    maxsize=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    backend=RedisBackend(CACHE_REDIS_URL) if CACHE_REDIS_URL else None,
+)
@@ -1,21 +1,117 @@
 from datetime import datetime, timedelta
 from PyQt6.QtWidgets import (
-    QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QListWidget,
+    QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QListView,
     QLineEdit, QTextEdit, QSpinBox, QComboBox
 )
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QAbstractListModel, QModelIndex, QTimer
+from api_client import ApiClient
 import sys
-import requests
-import re
 
-API_URL = "http://127.0.0.1:8000"
+PLACES_PAGE_SIZE = 100
+# typing pause before the search is sent, in milliseconds
+SEARCH_DELAY_MS = 300
+# seconds the server holds a payment status request open; below the read timeout
+PAYMENT_POLL_WAIT = 10
+
+
+class PlaceListModel(QAbstractListModel):
+    # Places are fetched a page at a time as the view scrolls (canFetchMore /
+    # fetchMore), so only the rows the user has reached are ever held.
+    # UserRole returns the place itself, so views never parse ids from text.
+
+    def __init__(self, api, page_size=PLACES_PAGE_SIZE):
+        super().__init__()
+        self.api = api
+        self.page_size = page_size
+        self.places = []
+        self.next_cursor = None
+        self.exhausted = False
+        self.pending = None
+        self.query = None
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.places)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        place = self.places[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            rating = place["rating"]
+            stars = f", ★ {rating['average']} ({rating['count']})" if rating["count"] else ""
+            return f"{place['name']} ({place['location']}) - {place['price_per_day']} $/день{stars}"
+        if role == Qt.ItemDataRole.UserRole:
+            return place
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted and self.pending is None
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        params = {"limit": self.page_size}
+        if self.next_cursor:
+            params["cursor"] = self.next_cursor
+        path = "/places/"
+        if self.query:
+            path = "/places/search"
+            params["q"] = self.query
+        self.pending = self.api.get(
+            path, self.on_page_loaded, self.on_page_failed, params=params)
+
+    def is_current(self):
+        # Replies to a request made before reload() belong to the old list.
+        return self.pending is not None and self.sender() is self.pending.signals
+
+    def on_page_loaded(self, response):
+        if not self.is_current():
+            return
+        self.pending = None
+        if response.status_code != 200:
+            self.on_page_failed(response.text)
+            return
+        page = response.json()
+        if page["items"]:
+            first = len(self.places)
+            self.beginInsertRows(QModelIndex(), first, first + len(page["items"]) - 1)
+            self.places.extend(page["items"])
+            self.endInsertRows()
+        self.next_cursor = page["next_cursor"]
+        self.exhausted = not self.next_cursor
+
+    def on_page_failed(self, error):
+        if self.pending is not None and not self.is_current():
+            return
+        self.pending = None
+        self.exhausted = True
+
+    def reload(self):
+        self.beginResetModel()
+        self.places = []
+        self.next_cursor = None
+        self.exhausted = False
+        self.pending = None
+        self.endResetModel()
+        self.fetchMore()
+
+    def set_query(self, query):
+        self.query = query.strip() or None
+        self.reload()
 
 
 class ReviewsWindow(QWidget):
-    def __init__(self, token, place_id=None):
+    # (place_id, cursor) -> (etag, page), shared by every window for the
+    # session so reopening reviews only revalidates the pages already seen.
+    page_cache = {}
+
+    def __init__(self, api, place_id=None):
         super().__init__()
-        self.token = token
+        self.api = api
         self.place_id = place_id
+        self.reviews = []
+        self.next_cursor = None
+        self.pending_cursor = None
         self.init_ui()
 
     def init_ui(self):
@@ -31,24 +127,57 @@ class ReviewsWindow(QWidget):
         self.reviews_list.setReadOnly(True)
         layout.addWidget(self.reviews_list)
 
+        self.more_button = QPushButton("Показать ещё")
+        self.more_button.clicked.connect(self.load_more)
+        layout.addWidget(self.more_button)
+
         self.load_reviews()
 
         self.setLayout(layout)
 
-    def load_reviews(self):
-        response = requests.get(
-            f"{API_URL}/reviews/{self.place_id}", headers={"Authorization": f"Bearer {self.token}"})
-        if response.status_code == 200:
-            reviews = response.json()
-            self.reviews_list.setText("\n\n".join(
-                [f"{"Пользователь "}{r['user_id']}: {r['rating']}\n{r['comment']}" for r in reviews]))
+    def load_reviews(self, cursor=None):
+        self.more_button.setEnabled(False)
+        cached = self.page_cache.get((self.place_id, cursor))
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        params = {"cursor": cursor} if cursor else {}
+        self.pending_cursor = cursor
+        self.api.get(f"/reviews/{self.place_id}", self.on_reviews_loaded,
+                     self.on_reviews_failed, headers=headers, params=params)
+
+    def on_reviews_loaded(self, response):
+        cursor = self.pending_cursor
+        key = (self.place_id, cursor)
+        if response.status_code == 304 and key in self.page_cache:
+            page = self.page_cache[key][1]
+        elif response.status_code == 200:
+            page = response.json()
+            etag = response.headers.get("ETag")
+            if etag:
+                self.page_cache[key] = (etag, page)
         else:
-            self.reviews_list.setText("Не удалось загрузить отзывы.")
+            self.on_reviews_failed(response.text)
+            return
+
+        if cursor is None:
+            self.reviews = []
+        self.reviews.extend(page["items"])
+        self.next_cursor = page["next_cursor"]
+        self.more_button.setEnabled(bool(self.next_cursor))
+        self.reviews_list.setText("\n\n".join(
+            [f"Пользователь {r['user_id']}: {r['rating']}\n{r['comment']}" for r in self.reviews]))
+
+    def on_reviews_failed(self, error):
+        self.reviews_list.setText("Не удалось загрузить отзывы.")
+
+    def load_more(self):
+        if self.next_cursor:
+            self.load_reviews(self.next_cursor)
 
 
 class RegistrationWindow(QWidget):
-    def __init__(self, parent=None):
+    def __init__(self, api, parent=None):
         super().__init__(parent)
+        self.api = api
         self.setWindowTitle("Регистрация")
         self.setGeometry(200, 200, 300, 200)
         self.setWindowOpacity(0.9)
@@ -88,23 +217,30 @@ class RegistrationWindow(QWidget):
         password = self.password_input.text()
         email = self.email_input.text()
 
-        response = requests.post(
-            f"{API_URL}/register/",
+        self.register_button.setEnabled(False)
+        self.api.post(
+            "/register/", self.on_registered, self.on_failed,
             json={"username": username, "email": email, "password": password}
         )
 
+    def on_registered(self, response):
+        self.register_button.setEnabled(True)
         if response.status_code == 201:
             self.status_label.setText("Регистрация успешна!")
             self.close()
         else:
             error_message = response.json().get("detail", "Ошибка регистрации!")
-            self.status_label.setText(error_message)
+            self.status_label.setText(str(error_message))
+
+    def on_failed(self, error):
+        self.register_button.setEnabled(True)
+        self.status_label.setText("Сервер недоступен!")
 
 
 class BookingApp(QWidget):
     def __init__(self):
         super().__init__()
-        self.token = None
+        self.api = ApiClient()
         self.init_ui()
 
     def init_ui(self):
@@ -137,8 +273,22 @@ class BookingApp(QWidget):
         self.logout_button.hide()
         layout.addWidget(self.logout_button)
 
-        self.list_widget = QListWidget()
-        layout.addWidget(self.list_widget)
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Поиск мест")
+        self.search_input.textChanged.connect(self.schedule_search)
+        layout.addWidget(self.search_input)
+
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.search_places)
+
+        self.places_model = PlaceListModel(self.api)
+
+        self.places_view = QListView()
+        self.places_view.setModel(self.places_model)
+        self.places_view.setUniformItemSizes(True)
+        layout.addWidget(self.places_view)
 
         self.load_button = QPushButton("Загрузить места")
         self.load_button.clicked.connect(self.load_places)
@@ -177,6 +327,7 @@ class BookingApp(QWidget):
         layout.addWidget(self.review_label)
 
         self.place_dropdown = QComboBox()
+        self.place_dropdown.setModel(self.places_model)
         layout.addWidget(self.place_dropdown)
 
         self.review_input = QTextEdit()
@@ -197,58 +348,69 @@ class BookingApp(QWidget):
         self.setLayout(layout)
 
     def open_reviews(self):
-        selected = self.place_dropdown.currentText()
-        match = re.search(r'\d+', selected)
-        if match:
-            place_id = int(match.group())
-        self.reviews_window = ReviewsWindow(self.token, place_id=place_id)
+        place = self.place_dropdown.currentData()
+        if not place:
+            self.label.setText("Выберите место!")
+            return
+        self.reviews_window = ReviewsWindow(self.api, place_id=place["id"])
         self.reviews_window.show()
 
     def cancel_booking(self):
-        selected = self.booking_dropdown.currentText()
-        if not selected:
+        selected_booking = self.booking_dropdown.currentData()
+        if not selected_booking:
             self.label.setText("Выберите бронирование!")
             return
 
-        match = re.search(r'\d+', selected)
-        if match:
-            booking_id = int(match.group())
-        else:
-            print("Ошибка: не удалось извлечь ID бронирования")
-
-        headers = {"Authorization": f"Bearer {self.token}"}
-
-        response = requests.post(
-            f"{API_URL}/cancel_booking/{booking_id}/", headers=headers)
+        booking_id = selected_booking["id"]
+        self.api.post(f"/cancel_booking/{booking_id}", self.on_booking_canceled,
+                      self.on_failed, params={"version": selected_booking["version"]})
 
+    def on_booking_canceled(self, response):
         if response.status_code == 200:
             self.label.setText("Бронирование отменено!")
+        elif response.status_code == 409:
+            self.label.setText(
+                "Бронирование уже изменено, обновите список бронирований!")
         else:
             self.label.setText("Ошибка при отмене бронирования!")
 
+    def on_failed(self, error):
+        self.label.setText("Сервер недоступен!")
+
     def open_registration(self):
-        self.registration_window = RegistrationWindow(self)
+        self.registration_window = RegistrationWindow(self.api, self)
         self.registration_window.show()
 
     def login(self):
         username = self.username_input.text()
         password = self.password_input.text()
-        response = requests.post(
-            f"{API_URL}/login/", json={"username": username, "password": password})
+        self.login_button.setEnabled(False)
+        self.api.post("/login/", self.on_logged_in, self.on_login_failed,
+                      json={"username": username, "password": password})
+
+    def on_logged_in(self, response):
+        self.login_button.setEnabled(True)
         if response.status_code == 200:
-            self.token = response.json()["access_token"]
-            self.label.setText(f"Добро пожаловать, {username}!")
+            self.api.token = response.json()["access_token"]
+            self.label.setText(f"Добро пожаловать, {self.username_input.text()}!")
 
             self.login_button.hide()
             self.register_button.hide()
             self.username_input.hide()
             self.password_input.hide()
             self.logout_button.show()
+        elif response.status_code == 429:
+            self.label.setText(
+                f"Слишком много попыток входа, повторите через {response.headers.get('Retry-After', '?')} с.")
         else:
             self.label.setText("Ошибка входа!")
 
+    def on_login_failed(self, error):
+        self.login_button.setEnabled(True)
+        self.on_failed(error)
+
     def logout(self):
-        self.token = None
+        self.api.token = None
         self.label.setText("Вы вышли из системы.")
 
         self.login_button.show()
@@ -256,49 +418,47 @@ class BookingApp(QWidget):
         self.logout_button.hide()
 
     def load_places(self):
-        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
-        response = requests.get(f"{API_URL}/places/", headers=headers)
-        if response.status_code == 200:
-            places = response.json()
-            self.list_widget.clear()
-            self.place_dropdown.clear()
-            for place in places:
-                self.list_widget.addItem(
-                    f"{place['id']} - {place['name']} ({place['location']}) - {place['price_per_day']} $/день")
-                self.place_dropdown.addItem(
-                    f"{place['id']} - {place['name']} ({place['location']})")
+        self.places_model.reload()
+
+    def schedule_search(self):
+        self.search_timer.start()
+
+    def search_places(self):
+        self.places_model.set_query(self.search_input.text())
 
     def book_place(self):
-        if not self.token:
+        if not self.api.token:
             self.label.setText("Сначала войдите в систему!")
             return
 
-        selected = self.list_widget.currentItem()
-        if not selected:
+        place = self.places_view.currentIndex().data(Qt.ItemDataRole.UserRole)
+        if not place:
             self.label.setText("Выберите место!")
             return
 
-        place_id = int(selected.text().split(" - ")[0])
+        place_id = place["id"]
         days = self.days_input.value()
         start_date = datetime.now().strftime("%Y-%m-%d")
         end_date = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
-        headers = {"Authorization": f"Bearer {self.token}"}
-        response = requests.post(f"{API_URL}/book/", json={"place_id": place_id,
-                                 "start_date": start_date, "end_date": end_date}, headers=headers)
+        self.api.post("/book/", self.on_booked, self.on_failed, json={
+            "place_id": place_id, "start_date": start_date, "end_date": end_date})
 
+    def on_booked(self, response):
         if response.status_code == 200:
             self.label.setText("Бронирование успешно!")
+        elif response.status_code == 409:
+            self.label.setText("Место уже занято на эти даты!")
         else:
             self.label.setText("Ошибка бронирования!")
 
     def load_bookings(self):
-        if not self.token:
+        if not self.api.token:
             self.label.setText("Сначала войдите в систему!")
             return
 
-        headers = {"Authorization": f"Bearer {self.token}"}
-        response = requests.get(f"{API_URL}/my_bookings/", headers=headers)
+        self.api.get("/my_bookings/", self.on_bookings_loaded, self.on_failed)
 
+    def on_bookings_loaded(self, response):
         if response.status_code == 200:
             bookings = response.json()
             self.booking_dropdown.clear()
@@ -321,30 +481,20 @@ class BookingApp(QWidget):
                         f"Ошибка даты в бронировании {booking_id}: {start_date_str} - {end_date_str}")
                     continue
 
-                place_id = booking.get("place_id")
-                if not place_id:
-                    price_per_day = 0
-                else:
-                    place_response = requests.get(
-                        f"{API_URL}/places/{place_id}", headers=headers)
-                    if place_response.status_code == 200:
-                        place_data = place_response.json()
-                        price_per_day = place_data.get("price_per_day", 0)
-                    else:
-                        price_per_day = 0
-
-                booking_amount = num_days * price_per_day
+                place = booking.get("place") or {}
+                price_per_day = place.get("price_per_day", 0)
+                booking_amount = booking.get("total_price", 0)
 
                 self.booking_dropdown.addItem(
-                    f"Бронь {booking_id}, {num_days} дней, сумма: {booking_amount} $, статус: {status}",
-                    userData={"id": booking_id,
+                    f"Бронь {booking_id} ({place.get('name', '?')}), {num_days} дней, сумма: {booking_amount} $, статус: {status}",
+                    userData={"id": booking_id, "version": booking.get("version"),
                               "price_per_day": price_per_day, "num_days": num_days, "status": status}
                 )
         else:
             self.label.setText("Ошибка загрузки бронирований!")
 
     def process_payment(self):
-        if not self.token:
+        if not self.api.token:
             self.label.setText("Сначала войдите в систему!")
             return
 
@@ -358,44 +508,69 @@ class BookingApp(QWidget):
         num_days = selected_booking["num_days"]
         total_price = price_per_day * num_days
 
-        headers = {"Authorization": f"Bearer {self.token}"}
-        response = requests.post(
-            f"{API_URL}/pay/",
-            json={"booking_id": booking_id, "amount": total_price},
-            headers=headers
+        self.api.post(
+            "/pay/", self.on_paid, self.on_failed,
+            json={"booking_id": booking_id, "amount": total_price,
+                  "version": selected_booking["version"]},
         )
 
-        if response.status_code == 200:
-            self.label.setText(f"Оплата успешна! Сумма: {total_price} $")
-        elif response.status_code == 400:
+    def on_paid(self, response):
+        if response.status_code == 202:
+            self.label.setText("Оплата обрабатывается...")
+            self.poll_payment(response.json()["payment_id"])
+        elif response.status_code == 409:
             self.label.setText(
                 "Ошибка оплаты! Бронирование уже оплачено или отменено.")
+        elif response.status_code == 503:
+            self.label.setText("Сервис оплаты перегружен, попробуйте позже.")
         else:
             self.label.setText(f"Ошибка оплаты: {response.text}")
 
+    def poll_payment(self, payment_id):
+        # Long poll: the server answers as soon as the payment settles.
+        self.api.get(f"/payments/{payment_id}", self.on_payment_status, self.on_failed,
+                     params={"wait": PAYMENT_POLL_WAIT})
+
+    def on_payment_status(self, response):
+        if response.status_code != 200:
+            self.label.setText("Ошибка оплаты: платёж не найден")
+            return
+        payment = response.json()
+        if payment["status"] in ("pending", "processing"):
+            self.poll_payment(payment["id"])
+        elif payment["status"] == "paid":
+            self.label.setText(f"Оплата успешна! Сумма: {payment['amount']} $")
+            self.load_bookings()
+        else:
+            self.label.setText("Платёж отклонён!")
+
     def leave_review(self):
-        if not self.token:
+        if not self.api.token:
             self.label.setText("Сначала войдите в систему!")
             return
 
-        selected = self.place_dropdown.currentText()
-        if not selected:
+        place = self.place_dropdown.currentData()
+        if not place:
             self.label.setText("Выберите место!")
             return
 
-        place_id = int(selected.split(" - ")[0])
+        place_id = place["id"]
         rating = self.rating_input.value()
         comment = self.review_input.toPlainText()
-        headers = {"Authorization": f"Bearer {self.token}"}
-
-        response = requests.post(f"{API_URL}/review/", json={
+        self.api.post("/review/", self.on_review_sent, self.on_failed, json={
             "place_id": place_id,
             "rating": rating,
             "comment": comment
-        }, headers=headers)
+        })
 
+    def on_review_sent(self, response):
         if response.status_code == 200:
             self.label.setText("Отзыв оставлен!")
+        elif response.status_code == 202:
+            # buffered on the server, written with the next batch
+            self.label.setText("Отзыв принят и скоро появится!")
+        elif response.status_code == 503:
+            self.label.setText("Сервис отзывов перегружен, попробуйте позже.")
         else:
             self.label.setText("Ошибка при отправке отзыва!")
 
@@ -404,4 +579,6 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = BookingApp()
     window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    window.api.close()
+    sys.exit(exit_code)
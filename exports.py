@@ -0,0 +1,66 @@
+import csv
+import enum
+import io
+from datetime import datetime
+import orjson
+from sqlalchemy import select
+import database
+import models
+
+EXPORT_BATCH_SIZE = 1000
+
+# kind -> (model, column the date range applies to, exported columns)
+EXPORTS = {
+    "bookings": (models.Booking, models.Booking.start_date,
+                 ("id", "user_id", "place_id", "start_date", "end_date", "status", "version")),
+    "payments": (models.Payment, models.Payment.timestamp,
+                 ("id", "booking_id", "amount", "status", "timestamp")),
+    "reviews": (models.Review, models.Review.created_at,
+                ("id", "user_id", "place_id", "rating", "comment", "created_at")),
+}
+
+
+async def export_batches(kind: str, date_from: datetime = None, date_to: datetime = None):
+    # Rows come off a server-side cursor EXPORT_BATCH_SIZE at a time and are
+    # plain tuples rather than ORM objects, so memory does not grow with the
+    # size of the export. The session is opened here rather than taken from
+    # get_db because the body is streamed after the route has returned.
+    model, date_column, columns = EXPORTS[kind]
+    query = select(*[getattr(model, column) for column in columns])
+    if date_from is not None:
+        query = query.where(date_column >= date_from)
+    if date_to is not None:
+        query = query.where(date_column < date_to)
+    query = query.order_by(model.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    async with database.SessionLocal() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            yield rows
+
+
+def csv_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def ndjson_stream(kind: str, date_from: datetime = None, date_to: datetime = None):
+    columns = EXPORTS[kind][2]
+    async for rows in export_batches(kind, date_from, date_to):
+        yield b"".join(orjson.dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+async def csv_stream(kind: str, date_from: datetime = None, date_to: datetime = None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORTS[kind][2])
+    async for rows in export_batches(kind, date_from, date_to):
+        writer.writerows([csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
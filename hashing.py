@@ -0,0 +1,100 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException
+from passlib.context import CryptContext
+from metrics import Histogram
+
+BCRYPT_EXECUTOR = os.getenv("BCRYPT_EXECUTOR", "thread")
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "2"))
+BCRYPT_MAX_QUEUE = int(os.getenv("BCRYPT_MAX_QUEUE", "32"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__ident="2b")
+
+
+def hash_password(password: str):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+class PasswordHasher:
+    # Runs bcrypt on its own small pool so hashing bursts cannot starve the
+    # threadpool that serves every other route. Work beyond
+    # workers + max_queue is rejected with 503 instead of queueing.
+
+    def __init__(self, workers: int, max_queue: int, kind: str = "thread"):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown bcrypt executor: {kind}")
+        self.workers = workers
+        self.max_queue = max_queue
+        self.kind = kind
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=503, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+            self.in_flight += 1
+            executor = self._get_executor()
+
+        started = time.perf_counter()
+        try:
+            result, run_seconds = await asyncio.wrap_future(executor.submit(_timed, func, *args))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+        self.run_time.observe(run_seconds)
+        self.wait_time.observe(time.perf_counter() - started - run_seconds)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def stats(self):
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight - self.workers),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_time.snapshot(),
+            "run_seconds": self.run_time.snapshot(),
+        }
+
+
+hasher = PasswordHasher(BCRYPT_WORKERS, BCRYPT_MAX_QUEUE, BCRYPT_EXECUTOR)
@@ -1,15 +1,84 @@
 from fastapi import HTTPException, status
 from fastapi import Depends
-from datetime import datetime
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
+from datetime import date, datetime
+from fastapi import APIRouter, FastAPI, Depends, HTTPException, Query, Header, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy import case, func, insert, literal, or_, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from contextlib import asynccontextmanager
+from typing import Dict, List, Literal, Optional
+import hashlib
+import orjson
 from auth import get_current_user
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 import models
 import database
 import auth
-
-app = FastAPI()
+import availability
+import cache
+import exports
+import hashing
+import metrics
+import payments
+import ratelimit
+import ratings
+import reviews
+import rollups
+import search
+from settings import Settings
+
+
+
+router = APIRouter()
+
+PLACES_PAGE_SIZE = 50
+PLACES_MAX_PAGE_SIZE = 200
+BOOKING_BATCH_MAX = 100
+BOOKING_BATCH_ATTEMPTS = 3
+REVIEWS_PAGE_SIZE = 20
+REVIEWS_MAX_PAGE_SIZE = 100
+PAYMENT_MAX_WAIT = 30
+SEARCH_MAX_QUERY_LENGTH = 200
+# ranked results are paged by offset; deeper pages cost a longer scan
+SEARCH_MAX_OFFSET = 1000
+
+# Most SQL statements a request may run, counting the user lookup on a cold
+# auth cache. Going over logs a warning, or raises with QUERY_BUDGET_STRICT=1.
+QUERY_BUDGETS = {
+    ("POST", "/register/"): 2,
+    ("POST", "/login/"): 1,
+    ("POST", "/book/"): 3,
+    ("GET", "/my_bookings/"): 2,
+    ("POST", "/cancel_booking/{booking_id}"): 4,
+    ("POST", "/pay/"): 2,
+    ("GET", "/payments/{payment_id}"): 3,
+    ("POST", "/review/"): 3,
+    ("GET", "/reviews/{place_id}"): 2,
+    ("GET", "/places/"): 1,
+    ("GET", "/places/search"): 1,
+    ("GET", "/places/{place_id}"): 1,
+    ("GET", "/places/{place_id}/availability"): 1,
+    ("GET", "/admin/stats/occupancy"): 2,
+    ("GET", "/admin/stats/revenue"): 2,
+}
+for (method, path), limit in QUERY_BUDGETS.items():
+    metrics.registry.set_budget(method, path, limit)
+
+# Token buckets as "requests/seconds" ("off" disables one). Login is limited
+# per address and per username tried, so a credential-stuffing burst is
+# turned away before any bcrypt work.
+LOGIN_IP_LIMIT = ratelimit.env_limit("RATE_LIMIT_LOGIN_IP", "20/60")
+LOGIN_USER_LIMIT = ratelimit.env_limit("RATE_LIMIT_LOGIN_USER", "5/60")
+REGISTER_IP_LIMIT = ratelimit.env_limit("RATE_LIMIT_REGISTER_IP", "5/60")
+WRITE_IP_LIMIT = ratelimit.env_limit("RATE_LIMIT_WRITE_IP", "120/60")
+WRITE_USER_LIMIT = ratelimit.env_limit("RATE_LIMIT_WRITE_USER", "30/60")
+
+
+def write_limit(name: str):
+    return ratelimit.rate_limit(name, per_ip=WRITE_IP_LIMIT, per_user=WRITE_USER_LIMIT,
+                                user_key=ratelimit.token_username)
 
 
 class UserCreate(BaseModel):
@@ -33,40 +102,133 @@ class BookingCreate(BaseModel):
     start_date: datetime
     end_date: datetime
 
+    @field_validator("start_date", "end_date")
+    @classmethod
+    def to_naive_utc(cls, value):
+        return availability.naive_utc(value)
+
+
+class BookingBatchCreate(BaseModel):
+    items: List[BookingCreate] = Field(..., min_length=1, max_length=BOOKING_BATCH_MAX)
+    # all-or-nothing by default; False books what it can and reports the rest
+    atomic: bool = True
+
 
 class PaymentCreate(BaseModel):
     booking_id: int
     amount: float
+    # version from /my_bookings/; when given, the payment fails with 409 if
+    # the booking changed since it was read
+    version: Optional[int] = None
 
 
 class ReviewCreate(BaseModel):
     place_id: int
-    rating: int
+    rating: int = Field(..., ge=1, le=5)
     comment: str
 
 
-@app.post("/register/", status_code=status.HTTP_201_CREATED)
-def register(user_data: UserCreate, db: Session = Depends(database.get_db)):
-    if auth.get_user_by_username(db, user_data.username):
+class RatingSummary(BaseModel):
+    count: int
+    average: Optional[float]
+    histogram: Dict[str, int]
+
+
+class PlaceOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: Optional[str]
+    type: Optional[str]
+    location: Optional[str]
+    description: Optional[str]
+    price_per_day: Optional[float]
+    rating: RatingSummary
+
+    @field_validator("rating", mode="before")
+    @classmethod
+    def summarize_rating(cls, rating):
+        if isinstance(rating, (dict, RatingSummary)):
+            return rating
+        return ratings.summary(rating)
+
+
+class PlacePage(BaseModel):
+    items: List[PlaceOut]
+    next_cursor: Optional[str]
+
+
+class BookingPlace(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: Optional[str]
+    location: Optional[str]
+    price_per_day: Optional[float]
+
+
+class BookingOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    place_id: Optional[int]
+    start_date: datetime
+    end_date: datetime
+    status: models.BookingStatus
+    version: int
+    place: Optional[BookingPlace]
+    total_price: float
+
+
+class ReviewOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: Optional[int]
+    place_id: Optional[int]
+    rating: int
+    comment: Optional[str]
+    created_at: datetime
+
+
+class ReviewPage(BaseModel):
+    items: List[ReviewOut]
+    next_cursor: Optional[str]
+
+
+class PaymentOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    booking_id: Optional[int]
+    amount: float
+    status: models.PaymentStatus
+    timestamp: datetime
+
+
+@router.post("/register/", status_code=status.HTTP_201_CREATED,
+             dependencies=[ratelimit.rate_limit("register", per_ip=REGISTER_IP_LIMIT)])
+async def register(user_data: UserCreate, db: AsyncSession = Depends(database.get_db)):
+    if await auth.get_user_by_username(db, user_data.username):
         raise HTTPException(status_code=400, detail="Username already exists")
 
-    hashed_password = auth.hash_password(user_data.password)
+    hashed_password = await auth.hash_password_async(user_data.password)
     new_user = models.User(
         username=user_data.username,
         email=user_data.email,
         password_hash=hashed_password,
     )
     db.add(new_user)
-    db.commit()
+    await db.commit()
 
-    response = {"message": "User registered successfully"}
-    print("API Response:", response)
-    return response
+    return {"message": "User registered successfully"}
 
 
-@app.post("/login/", response_model=TokenResponse)
-def login(user_data: UserLogin, db: Session = Depends(database.get_db)):
-    user = auth.authenticate_user(db, user_data.username, user_data.password)
+@router.post("/login/", response_model=TokenResponse,
+             dependencies=[ratelimit.rate_limit("login", per_ip=LOGIN_IP_LIMIT, per_user=LOGIN_USER_LIMIT,
+                                                user_key=ratelimit.body_username)])
+async def login(user_data: UserLogin, db: AsyncSession = Depends(database.get_db)):
+    user = await auth.authenticate_user(db, user_data.username, user_data.password)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -74,70 +236,257 @@ def login(user_data: UserLogin, db: Session = Depends(database.get_db)):
     return {"access_token": token, "token_type": "bearer"}
 
 
-@app.get("/protected/")
-def protected_route(user: models.User = Depends(get_current_user)):
+@router.get("/protected/")
+async def protected_route(user: models.User = Depends(get_current_user)):
     return {"message": f"Hello, {user.username}"}
 
 
-@app.post("/book/")
-def book_place(booking_data: BookingCreate, user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    new_booking = models.Booking(
-        user_id=user.id,
-        place_id=booking_data.place_id,
-        start_date=booking_data.start_date,
-        end_date=booking_data.end_date,
-        status="pending"
+@router.post("/book/", dependencies=[write_limit("book")])
+async def book_place(booking_data: BookingCreate, user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    if booking_data.end_date <= booking_data.start_date:
+        raise HTTPException(status_code=400, detail="Invalid booking period")
+
+    try:
+        booking_id = await availability.book(
+            db, user.id, booking_data.place_id, booking_data.start_date, booking_data.end_date)
+        if booking_id is not None:
+            changes = rollups.Changes()
+            changes.booked(booking_data.place_id, booking_data.start_date, booking_data.end_date)
+            await rollups.apply(db, changes)
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Place is already booked for these dates")
+    if booking_id is None:
+        await db.rollback()
+        if await db.get(models.Place, booking_data.place_id) is None:
+            raise HTTPException(status_code=404, detail="Place not found")
+        raise HTTPException(status_code=409, detail="Place is already booked for these dates")
+    return {"message": "Booking request sent", "booking_id": booking_id}
+
+
+@router.post("/book/batch", dependencies=[write_limit("book")])
+async def book_places(batch: BookingBatchCreate, user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    # A single /book/ committed between the check and the insert trips the
+    # exclusion constraint on Postgres; the batch is then checked again, so
+    # the clash shows up as that item's error instead of failing the batch.
+    for attempt in range(BOOKING_BATCH_ATTEMPTS):
+        errors = await availability.check_batch(db, batch.items)
+        if batch.atomic and any(errors):
+            await db.rollback()
+            raise HTTPException(status_code=409, detail=[
+                {"index": index, "error": error} for index, error in enumerate(errors) if error])
+
+        accepted = [index for index, error in enumerate(errors) if not error]
+        booking_ids = []
+        if not accepted:
+            break
+        rows = [{
+            "user_id": user.id,
+            "place_id": batch.items[index].place_id,
+            "start_date": batch.items[index].start_date,
+            "end_date": batch.items[index].end_date,
+            "status": models.BookingStatus.pending,
+        } for index in accepted]
+        try:
+            result = await db.execute(insert(models.Booking).returning(
+                models.Booking.id, sort_by_parameter_order=True), rows)
+            booking_ids = result.scalars().all()
+            changes = rollups.Changes()
+            for row in rows:
+                changes.booked(row["place_id"], row["start_date"], row["end_date"])
+            await rollups.apply(db, changes)
+            await db.commit()
+            break
+        except IntegrityError:
+            await db.rollback()
+    else:
+        raise HTTPException(status_code=409, detail="Places were booked concurrently, try again")
+
+    booking_id_by_index = dict(zip(accepted, booking_ids))
+    return {
+        "message": "Booking requests sent",
+        "results": [
+            {"index": index, "booking_id": booking_id_by_index[index]} if not error
+            else {"index": index, "error": error}
+            for index, error in enumerate(errors)
+        ],
+    }
+
+
+def booking_with_place(booking: models.Booking):
+    place = booking.place
+    price_per_day = place.price_per_day if place else 0
+    num_days = (booking.end_date - booking.start_date).days
+    return BookingOut(
+        id=booking.id,
+        place_id=booking.place_id,
+        start_date=booking.start_date,
+        end_date=booking.end_date,
+        status=booking.status,
+        version=booking.version,
+        place=BookingPlace.model_validate(place) if place else None,
+        total_price=num_days * price_per_day,
     )
-    db.add(new_booking)
-    db.commit()
-    return {"message": "Booking request sent", "booking_id": new_booking.id}
-
-
-@app.get("/my_bookings/")
-def get_user_bookings(user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    bookings = db.query(models.Booking).filter(
-        models.Booking.user_id == user.id).all()
-    return bookings
-
-
-@app.post("/cancel_booking/{booking_id}")
-def cancel_booking(booking_id: int, user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    booking = db.query(models.Booking).filter(
-        models.Booking.id == booking_id, models.Booking.user_id == user.id).first()
-    if not booking:
-        return {"error": "Booking not found"}
-    booking.status = "canceled"
-    payment = db.query(models.Payment).filter(
-        models.Payment.booking_id == booking_id).first()
-    if payment:
-        db.delete(payment)
-    db.commit()
-    return {"message": "Booking cancelled"}
 
 
-@app.post("/pay/")
-def process_payment(payment_data: PaymentCreate, user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
-    booking = db.query(models.Booking).filter(
-        models.Booking.id == payment_data.booking_id, models.Booking.user_id == user.id).first()
-    if not booking:
-        raise HTTPException(status_code=404, detail="Booking not found")
+@router.get("/my_bookings/", response_model=List[BookingOut])
+async def get_user_bookings(user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    result = await db.execute(select(models.Booking).options(joinedload(models.Booking.place)).where(
+        models.Booking.user_id == user.id).order_by(models.Booking.id))
+    bookings = result.scalars().all()
+    return [booking_with_place(booking) for booking in bookings]
+
+
+def owned_booking(booking_id: int, user: models.User, version: Optional[int]):
+    conditions = [models.Booking.id == booking_id, models.Booking.user_id == user.id]
+    if version is not None:
+        conditions.append(models.Booking.version == version)
+    return conditions
+
+
+async def booking_conflict(db: AsyncSession, booking_id: int, user: models.User, version: Optional[int], conflict_detail: str):
+    # Explains why a conditional write matched no booking. Only runs on the
+    # failure path, so successful writes stay a single statement.
+    await db.rollback()
+    result = await db.execute(select(models.Booking.version).where(
+        models.Booking.id == booking_id, models.Booking.user_id == user.id))
+    current_version = result.scalar()
+    if current_version is None:
+        return HTTPException(status_code=404, detail="Booking not found")
+    if version is not None and current_version != version:
+        return HTTPException(status_code=409, detail="Booking was modified, reload and retry")
+    return HTTPException(status_code=409, detail=conflict_detail)
+
+
+@router.post("/cancel_booking/{booking_id}", dependencies=[write_limit("cancel")])
+async def cancel_booking(booking_id: int, version: Optional[int] = None, user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    # Compare-and-set on status/version: concurrent transitions race on the
+    # row instead of waiting on a lock, and the loser gets 409. On Postgres
+    # the payment update rides along in the same statement as a CTE.
+    bookings, booking_payments = models.Booking.__table__, models.Payment.__table__
+    canceled = update(bookings).where(
+        *owned_booking(booking_id, user, version),
+        bookings.c.status != models.BookingStatus.canceled,
+    ).values(status=models.BookingStatus.canceled, version=bookings.c.version + 1).returning(
+        bookings.c.id, bookings.c.place_id, bookings.c.start_date, bookings.c.end_date)
+    # The paid payment is marked for refund and a pending one fails before
+    # it is charged. A payment being charged is left to its worker, which
+    # fails and refunds it once it finds the booking canceled.
+    settled = update(booking_payments).where(
+        booking_payments.c.status.in_([models.PaymentStatus.pending, models.PaymentStatus.paid]),
+    ).values(status=case(
+        (booking_payments.c.status == models.PaymentStatus.paid,
+         literal(models.PaymentStatus.refunding, booking_payments.c.status.type)),
+        else_=literal(models.PaymentStatus.failed, booking_payments.c.status.type),
+    )).returning(booking_payments.c.id, booking_payments.c.amount, booking_payments.c.status)
+
+    # The rollups need the booking's nights and the paid amount being
+    # refunded; there is at most one paid payment per booking.
+    if db.get_bind().dialect.name == "postgresql":
+        canceled = canceled.cte("canceled")
+        settled = settled.where(booking_payments.c.booking_id.in_(select(canceled.c.id))).cte("settled")
+        refund = settled.c.status == models.PaymentStatus.refunding
+        found = (await db.execute(select(
+            canceled,
+            select(settled.c.id).where(refund).scalar_subquery(),
+            select(settled.c.amount).where(refund).scalar_subquery(),
+        ))).first()
+    else:
+        found = (await db.execute(canceled)).first()
+        if found is not None:
+            result = await db.execute(settled.where(booking_payments.c.booking_id == booking_id))
+            refund = next((row for row in result if row.status == models.PaymentStatus.refunding), None)
+            found = (*found, *(refund[:2] if refund else (None, None)))
+    if found is None:
+        raise await booking_conflict(db, booking_id, user, version, "Booking is already canceled")
+    _, place_id, start_date, end_date, refund_id, refunded = found
+    changes = rollups.Changes()
+    changes.booked(place_id, start_date, end_date, sign=-1)
+    changes.canceled(place_id, start_date)
+    if refunded:
+        changes.paid(place_id, start_date, end_date, refunded, sign=-1)
+    await rollups.apply(db, changes)
+    await db.commit()
+    if refund_id is not None:
+        payments.processor.enqueue(refund_id)
+    return {"message": "Booking cancelled"}
 
-    if booking.status != "pending":
-        raise HTTPException(status_code=400, detail="Booking is not pending")
 
-    new_payment = models.Payment(
-        booking_id=payment_data.booking_id,
-        amount=payment_data.amount,
-        status="paid"
+@router.post("/pay/", status_code=status.HTTP_202_ACCEPTED, dependencies=[write_limit("pay")])
+async def process_payment(payment_data: PaymentCreate, response: Response, user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    # Only records the payment as pending; payments.processor charges it in
+    # the background and confirms the booking. Poll /payments/{id} for the
+    # outcome. The booking checks and the insert are one INSERT ... SELECT.
+    payments.processor.check_capacity()
+    source = select(
+        models.Booking.id,
+        literal(payment_data.amount, models.Payment.amount.type),
+        literal(models.PaymentStatus.pending, models.Payment.status.type),
+    ).where(
+        *owned_booking(payment_data.booking_id, user, payment_data.version),
+        models.Booking.status == models.BookingStatus.pending,
     )
-    booking.status = "confirmed"
-    db.add(new_payment)
-    db.commit()
-    return {"message": "Payment successful", "payment_id": new_payment.id}
-
+    try:
+        result = await db.execute(insert(models.Payment).from_select(
+            ["booking_id", "amount", "status"], source).returning(models.Payment.id))
+        payment_id = result.scalar()
+        if payment_id is None:
+            raise await booking_conflict(
+                db, payment_data.booking_id, user, payment_data.version, "Booking is not pending")
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Booking is already paid or being paid")
+    payments.processor.enqueue(payment_id)
+
+    response.headers["Location"] = f"/payments/{payment_id}"
+    return {"message": "Payment accepted", "payment_id": payment_id, "status": models.PaymentStatus.pending}
+
+
+@router.get("/payments/{payment_id}", response_model=PaymentOut)
+async def get_payment(
+    payment_id: int,
+    wait: float = Query(0, ge=0, le=PAYMENT_MAX_WAIT),
+    user: models.User = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(database.get_db),
+):
+    # With wait > 0 a pending (or refunding) payment is held open until it
+    # settles or the wait runs out (long polling); the connection goes back
+    # to the pool meanwhile.
+    query = select(models.Payment).join(models.Booking).where(
+        models.Payment.id == payment_id, models.Booking.user_id == user.id)
+    payment = (await db.execute(query)).scalars().first()
+    if payment is None:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    if wait and payment.status in (
+            models.PaymentStatus.pending, models.PaymentStatus.processing, models.PaymentStatus.refunding):
+        await db.commit()
+        await payments.processor.wait(payment_id, wait)
+        payment = (await db.execute(query.execution_options(populate_existing=True))).scalars().first()
+        if payment is None:
+            raise HTTPException(status_code=404, detail="Payment not found")
+    return payment
+
+
+@router.post("/review/", dependencies=[write_limit("review")])
+async def leave_review(review_data: ReviewCreate, response: Response, user: models.User = Depends(auth.get_current_user), db: AsyncSession = Depends(database.get_db)):
+    if reviews.review_buffer.buffered:
+        # Give the connection back first: waiting requests must not starve
+        # the flush that releases them.
+        await db.close()
+        await reviews.review_buffer.add({
+            "user_id": user.id,
+            "place_id": review_data.place_id,
+            "rating": review_data.rating,
+            "comment": review_data.comment,
+            "created_at": datetime.utcnow(),
+        })
+        if reviews.review_buffer.mode == "buffered":
+            response.status_code = status.HTTP_202_ACCEPTED
+            return {"message": "Review accepted"}
+        return {"message": "Review submitted"}
 
-@app.post("/review/")
-def leave_review(review_data: ReviewCreate, user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
     new_review = models.Review(
         user_id=user.id,
         place_id=review_data.place_id,
@@ -145,24 +494,347 @@ def leave_review(review_data: ReviewCreate, user: models.User = Depends(auth.get
         comment=review_data.comment
     )
     db.add(new_review)
-    db.commit()
+    await ratings.record_ratings(db, review_data.place_id, [review_data.rating])
+    await db.commit()
+    await cache.place_cache.invalidate("places", f"place:{review_data.place_id}")
     return {"message": "Review submitted"}
 
 
-@app.get("/reviews/{place_id}")
-def get_reviews(place_id: int, db: Session = Depends(database.get_db)):
-    reviews = db.query(models.Review).filter(
-        models.Review.place_id == place_id).all()
-    return reviews
-
-
-@app.get("/places/")
-def get_places(db: Session = Depends(database.get_db)):
-    places = db.query(models.Place).all()
-    return places
-
-
-@app.get("/places/{place_id}")
-def get_place(place_id: int, db: Session = Depends(database.get_db)):
-    place = db.query(models.Place).filter(models.Place.id == place_id).first()
-    return place
+def parse_reviews_cursor(cursor: str):
+    try:
+        created_at, review_id = cursor.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(review_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def reviews_etag(place_id: int, rating: Optional[models.PlaceRating], cursor: Optional[str], limit: int):
+    # Reviews are append-only and every insert bumps the place's aggregate,
+    # so the aggregate row versions all review pages of the place.
+    count, rating_sum = (rating.count, rating.rating_sum) if rating else (0, 0)
+    key = f"{place_id}:{count}:{rating_sum}:{cursor}:{limit}"
+    return '"' + hashlib.sha1(key.encode()).hexdigest()[:20] + '"'
+
+
+@router.get("/reviews/{place_id}", response_model=ReviewPage)
+async def get_reviews(
+    place_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(REVIEWS_PAGE_SIZE, ge=1, le=REVIEWS_MAX_PAGE_SIZE),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(database.get_db),
+):
+    rating = await db.get(models.PlaceRating, place_id)
+    etag = reviews_etag(place_id, rating, cursor, limit)
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    query = select(models.Review).where(models.Review.place_id == place_id)
+    if cursor is not None:
+        query = query.where(tuple_(models.Review.created_at, models.Review.id) < parse_reviews_cursor(cursor))
+    result = await db.execute(query.order_by(
+        models.Review.created_at.desc(), models.Review.id.desc()).limit(limit + 1))
+    reviews = result.scalars().all()
+
+    next_cursor = None
+    if len(reviews) > limit:
+        reviews = reviews[:limit]
+        next_cursor = f"{reviews[-1].created_at.isoformat()}|{reviews[-1].id}"
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return ReviewPage(items=[ReviewOut.model_validate(review) for review in reviews], next_cursor=next_cursor)
+
+
+async def cached_json(namespace: str, request: Request, build):
+    # Place payloads are cached as ready-to-send JSON bytes, keyed by the
+    # normalized query string and versioned per namespace by the cache backend.
+    key = tuple(sorted(request.query_params.multi_items()))
+    cache_key, body = await cache.place_cache.lookup(namespace, key)
+    status = "HIT"
+    if body is None:
+        body = orjson.dumps((await build()).model_dump())
+        cache.place_cache.store(cache_key, body)
+        status = "MISS"
+    return Response(content=body, media_type="application/json", headers={"X-Cache": status})
+
+
+def parse_place_ids(ids: str):
+    try:
+        place_ids = {int(place_id) for place_id in ids.split(",") if place_id.strip()}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid place ids")
+    if len(place_ids) > PLACES_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail="Too many place ids")
+    return place_ids
+
+
+def parse_places_cursor(cursor: str, sort: str):
+    try:
+        if sort == "price":
+            price, place_id = cursor.split(":")
+            return (None if price == "null" else float(price)), int(place_id)
+        return int(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("/places/", response_model=PlacePage)
+async def get_places(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(PLACES_PAGE_SIZE, ge=1, le=PLACES_MAX_PAGE_SIZE),
+    sort: Literal["id", "price"] = "id",
+    place_type: Optional[str] = Query(None, alias="type"),
+    location: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    ids: Optional[str] = None,
+    db: AsyncSession = Depends(database.get_db),
+):
+    async def build():
+        query = select(models.Place)
+        if ids is not None:
+            result = await db.execute(query.where(
+                models.Place.id.in_(parse_place_ids(ids))).order_by(models.Place.id))
+            return PlacePage(items=[PlaceOut.model_validate(place) for place in result.scalars()], next_cursor=None)
+
+        if place_type is not None:
+            query = query.where(models.Place.type == place_type)
+        if location is not None:
+            query = query.where(models.Place.location == location)
+        if min_price is not None:
+            query = query.where(models.Place.price_per_day >= min_price)
+        if max_price is not None:
+            query = query.where(models.Place.price_per_day <= max_price)
+
+        if sort == "price":
+            # Places without a price come last, paged by id alone.
+            price = models.Place.price_per_day
+            if cursor is not None:
+                last_price, last_id = parse_places_cursor(cursor, sort)
+                if last_price is None:
+                    query = query.where(price.is_(None), models.Place.id > last_id)
+                else:
+                    query = query.where(or_(tuple_(price, models.Place.id) > (last_price, last_id), price.is_(None)))
+            query = query.order_by(price.asc().nulls_last(), models.Place.id)
+        else:
+            if cursor is not None:
+                query = query.where(models.Place.id > parse_places_cursor(cursor, sort))
+            query = query.order_by(models.Place.id)
+
+        # One extra row tells us whether another page exists without a COUNT(*).
+        result = await db.execute(query.limit(limit + 1))
+        places = result.scalars().all()
+        next_cursor = None
+        if len(places) > limit:
+            places = places[:limit]
+            last = places[-1]
+            if sort == "price":
+                price = "null" if last.price_per_day is None else last.price_per_day
+                next_cursor = f"{price}:{last.id}"
+            else:
+                next_cursor = str(last.id)
+        return PlacePage(items=[PlaceOut.model_validate(place) for place in places], next_cursor=next_cursor)
+
+    return await cached_json("places", request, build)
+
+
+def parse_search_cursor(cursor: str):
+    try:
+        offset = int(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not 0 <= offset <= SEARCH_MAX_OFFSET:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
+
+@router.get("/places/search", response_model=PlacePage)
+async def search_places(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=SEARCH_MAX_QUERY_LENGTH),
+    cursor: Optional[str] = None,
+    limit: int = Query(PLACES_PAGE_SIZE, ge=1, le=PLACES_MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(database.get_db),
+):
+    # Best matches first. The cursor is an offset into the ranking, so pages
+    # share the /places/ shape and the client pages both the same way.
+    async def build():
+        offset = parse_search_cursor(cursor) if cursor is not None else 0
+        places = await search.search_places(db, q, limit + 1, offset)
+        next_cursor = None
+        if len(places) > limit:
+            places = places[:limit]
+            if offset + limit <= SEARCH_MAX_OFFSET:
+                next_cursor = str(offset + limit)
+        return PlacePage(items=[PlaceOut.model_validate(place) for place in places], next_cursor=next_cursor)
+
+    return await cached_json("places", request, build)
+
+
+@router.get("/places/{place_id}", response_model=PlaceOut)
+async def get_place(place_id: int, request: Request, db: AsyncSession = Depends(database.get_db)):
+    async def build():
+        place = await db.get(models.Place, place_id)
+        if not place:
+            raise HTTPException(status_code=404, detail="Place not found")
+        return PlaceOut.model_validate(place)
+
+    return await cached_json(f"place:{place_id}", request, build)
+
+
+@router.get("/places/{place_id}/availability")
+async def get_availability(
+    place_id: int,
+    date_from: datetime = Query(..., alias="from"),
+    date_to: datetime = Query(..., alias="to"),
+    db: AsyncSession = Depends(database.get_db),
+):
+    date_from, date_to = availability.naive_utc(date_from), availability.naive_utc(date_to)
+    if date_to <= date_from:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+
+    windows = await availability.free_windows(db, place_id, date_from, date_to)
+    return {
+        "place_id": place_id,
+        "from": date_from,
+        "to": date_to,
+        "free": [{"start": start, "end": end} for start, end in windows],
+    }
+
+
+@router.get("/admin/export/{kind}")
+async def export_data(
+    kind: Literal["bookings", "payments", "reviews"],
+    format: Literal["ndjson", "csv"] = "ndjson",
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    admin: models.User = Depends(auth.get_current_admin),
+):
+    if format == "csv":
+        body, media_type = exports.csv_stream(kind, date_from, date_to), "text/csv"
+    else:
+        body, media_type = exports.ndjson_stream(kind, date_from, date_to), "application/x-ndjson"
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{kind}.{format}"'})
+
+
+@router.get("/admin/stats/occupancy")
+async def occupancy_report(
+    date_from: date = Query(..., alias="from"),
+    date_to: date = Query(..., alias="to"),
+    place_id: Optional[int] = None,
+    admin: models.User = Depends(auth.get_current_admin),
+    db: AsyncSession = Depends(database.get_db),
+):
+    # Reads only the daily rollups; places without activity in the range
+    # are left out.
+    if date_to <= date_from:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    days = (date_to - date_from).days
+    rows = await rollups.report(db, date_from, date_to, place_id)
+    return {
+        "from": date_from,
+        "to": date_to,
+        "days": days,
+        "places": [{
+            "place_id": row.place_id,
+            "booked_nights": row.booked_nights,
+            "occupancy": round(row.booked_nights / days, 4),
+            "cancellations": row.cancellations,
+        } for row in rows],
+    }
+
+
+@router.get("/admin/stats/revenue")
+async def revenue_report(
+    date_from: date = Query(..., alias="from"),
+    date_to: date = Query(..., alias="to"),
+    place_id: Optional[int] = None,
+    admin: models.User = Depends(auth.get_current_admin),
+    db: AsyncSession = Depends(database.get_db),
+):
+    if date_to <= date_from:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    rows = await rollups.report(db, date_from, date_to, place_id)
+    places = [{"place_id": row.place_id, "revenue": round(row.revenue, 2)} for row in rows]
+    return {
+        "from": date_from,
+        "to": date_to,
+        "places": places,
+        "total": round(sum(row.revenue for row in rows), 2),
+    }
+
+
+@router.post("/admin/stats/rebuild")
+async def rebuild_stats(admin: models.User = Depends(auth.get_current_admin),
+                        db: AsyncSession = Depends(database.get_db)):
+    # Recomputes the place ratings and the daily rollups from the source
+    # tables; also the way to backfill them on a database that predates them.
+    await ratings.rebuild(db)
+    await rollups.rebuild(db)
+    rated = (await db.execute(select(models.PlaceRating.place_id))).scalars().all()
+    await db.commit()
+    await cache.place_cache.invalidate("places", *[f"place:{place_id}" for place_id in rated])
+    return {"message": "Stats rebuilt"}
+
+
+@router.get("/internal/stats")
+async def internal_stats(admin: models.User = Depends(auth.get_current_admin)):
+    return {
+        "auth_cache": auth.cache_stats(),
+        "password_hasher": hashing.hasher.stats(),
+        "db_pool": database.pool_stats(),
+        "place_cache": cache.place_cache.entries.stats(),
+        "payments": payments.processor.stats(),
+        "review_buffer": reviews.review_buffer.stats(),
+        "rate_limits": ratelimit.limiter.stats(),
+    }
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    histograms = (
+        ("review_flush_batch_size", "Reviews written per flush.",
+         reviews.review_buffer.batch_sizes.snapshot()),
+        ("review_flush_duration_seconds", "Time to write one review batch.",
+         reviews.review_buffer.flush_time.snapshot()),
+        ("payment_provider_duration_seconds", "Payment provider call latency.",
+         payments.processor.provider_time.snapshot()),
+    )
+    return PlainTextResponse(metrics.registry.render(database.pool_stats(), histograms),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in each server worker after the fork: the engine, its pool and the
+    # signing key belong to the worker process.
+    settings = app.state.settings
+    auth.init_secrets(settings)
+    database.init_engine(settings)
+    try:
+        if settings.should_create_tables():
+            await database.create_tables()
+        await database.warm_up(settings.pool_warmup)
+        await payments.processor.start()
+        await reviews.review_buffer.start()
+        yield
+    finally:
+        await reviews.review_buffer.stop()
+        await payments.processor.stop()
+        await database.dispose_engine()
+        hashing.hasher.shutdown()
+
+
+def create_app(settings: Optional[Settings] = None):
+    app = FastAPI(lifespan=lifespan)
+    app.state.settings = settings or Settings()
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,257 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, value_sum = self.count, self.sum
+        cumulative = 0
+        buckets = {}
+        for upper_bound, count in zip(self.buckets, counts):
+            cumulative += count
+            buckets[str(upper_bound)] = cumulative
+        buckets["+Inf"] = total
+        return {"count": total, "sum": value_sum, "buckets": buckets}
+
+
+# Per-request accounting. The middleware opens a RequestStats for every HTTP
+# request and the engine hooks below add each SQL statement to it.
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100)
+# In strict mode a request that runs more statements than its route's budget
+# raises QueryBudgetExceeded instead of logging a warning; meant for test and
+# benchmark runs, where an N+1 regression should fail loudly.
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "false").lower() in ("1", "true", "yes")
+UNMATCHED_ROUTE = "<unmatched>"
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestStats:
+    __slots__ = ("queries", "sql_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+@contextmanager
+def track_request():
+    # Reuses the enclosing RequestStats when there is one, so an outer caller
+    # (a benchmark, a test) sees the statements of the whole request.
+    stats = current_request.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = RequestStats()
+    token = current_request.set(stats)
+    try:
+        yield stats
+    finally:
+        current_request.reset(token)
+
+
+@contextmanager
+def query_budget(limit: int, label: str = "block"):
+    with track_request() as stats:
+        before = stats.queries
+        yield stats
+        used = stats.queries - before
+    if used > limit:
+        raise QueryBudgetExceeded(f"{label} ran {used} SQL statements, budget is {limit}")
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.sql_seconds = Histogram()
+        self.responses = {}
+        self.budget_exceeded = 0
+
+
+class Registry:
+    def __init__(self):
+        self.routes = {}
+        self.budgets = {}
+        self.sql_seconds = Histogram()
+        self._lock = threading.Lock()
+
+    def route(self, method: str, path: str):
+        key = (method, path)
+        route = self.routes.get(key)
+        if route is None:
+            with self._lock:
+                route = self.routes.setdefault(key, RouteMetrics())
+        return route
+
+    def set_budget(self, method: str, path: str, limit: int):
+        self.budgets[(method, path)] = limit
+
+    def observe(self, method: str, path: str, status_code: int, seconds: float, stats: RequestStats):
+        route = self.route(method, path)
+        route.latency.observe(seconds)
+        route.queries.observe(stats.queries)
+        route.sql_seconds.observe(stats.sql_seconds)
+        with self._lock:
+            route.responses[status_code] = route.responses.get(status_code, 0) + 1
+
+        limit = self.budgets.get((method, path))
+        if limit is not None and stats.queries > limit:
+            with self._lock:
+                route.budget_exceeded += 1
+            return f"{method} {path} ran {stats.queries} SQL statements, budget is {limit}"
+        return None
+
+    def render(self, pool=None, histograms=()):
+        lines = []
+        routes = sorted(self.routes.items())
+
+        def header(name, kind, text):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        header("http_requests_total", "counter", "HTTP responses by route and status.")
+        for (method, path), route in routes:
+            for status_code, count in sorted(route.responses.items()):
+                lines.append(f"http_requests_total{labels(method=method, route=path, status=status_code)} {count}")
+
+        for name, attribute, text in (
+            ("http_request_duration_seconds", "latency", "Request latency."),
+            ("http_request_sql_queries", "queries", "SQL statements per request."),
+            ("http_request_sql_duration_seconds", "sql_seconds", "Time spent in SQL per request."),
+        ):
+            header(name, "histogram", text)
+            for (method, path), route in routes:
+                histogram_lines(lines, name, {"method": method, "route": path},
+                                getattr(route, attribute).snapshot())
+
+        header("http_request_query_budget_exceeded_total", "counter", "Requests over their route's query budget.")
+        for (method, path), route in routes:
+            if (method, path) in self.budgets:
+                lines.append(f"http_request_query_budget_exceeded_total{labels(method=method, route=path)} "
+                             f"{route.budget_exceeded}")
+
+        header("db_query_duration_seconds", "histogram", "Duration of every SQL statement.")
+        histogram_lines(lines, "db_query_duration_seconds", {}, self.sql_seconds.snapshot())
+
+        if pool:
+            for name, key, text in (
+                ("db_pool_size", "size", "Configured pool size."),
+                ("db_pool_checked_out", "checked_out", "Connections in use."),
+                ("db_pool_overflow", "overflow", "Overflow connections open."),
+                ("db_pool_waiting", "waiting", "Checkouts waiting for a connection."),
+            ):
+                header(name, "gauge", text)
+                lines.append(f"{name} {pool[key]}")
+            header("db_pool_timeouts_total", "counter", "Checkouts that timed out.")
+            lines.append(f"db_pool_timeouts_total {pool['timeouts']}")
+            header("db_pool_checkout_seconds", "histogram", "Time to check out a connection.")
+            histogram_lines(lines, "db_pool_checkout_seconds", {}, pool["checkout_seconds"])
+        for name, text, snapshot in histograms:
+            header(name, "histogram", text)
+            histogram_lines(lines, name, {}, snapshot)
+        return "\n".join(lines) + "\n"
+
+
+def labels(**values):
+    if not values:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in values.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(values, escaped)) + "}"
+
+
+def histogram_lines(lines, name, label_values, snapshot):
+    for upper_bound, count in snapshot["buckets"].items():
+        lines.append(f"{name}_bucket{labels(**label_values, le=upper_bound)} {count}")
+    lines.append(f"{name}_sum{labels(**label_values)} {snapshot['sum']}")
+    lines.append(f"{name}_count{labels(**label_values)} {snapshot['count']}")
+
+
+registry = Registry()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._metrics_started
+    registry.sql_seconds.observe(seconds)
+    stats = current_request.get()
+    if stats is not None:
+        stats.sql_seconds += seconds
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: the route template is only known once the router
+    # has matched, and it records into the scope, so it is read afterwards.
+
+    def __init__(self, app, registry=registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        over_budget = None
+        with track_request() as stats:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                path = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+                over_budget = self.registry.observe(
+                    scope["method"], path, status_code, time.perf_counter() - started, stats)
+        if over_budget:
+            if QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(over_budget)
+            logger.warning(over_budget)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, Date, DateTime, Float, Enum, Index, DDL, event, text
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -19,7 +19,12 @@ class BookingStatus(str, enum.Enum):
 class PaymentStatus(str, enum.Enum):
     paid = "paid"
     pending = "pending"
+    # claimed by a payment worker, charge in progress
+    processing = "processing"
     failed = "failed"
+    # booking canceled after it was paid; refunding until the provider confirms
+    refunding = "refunding"
+    refunded = "refunded"
 
 
 class User(Base):
@@ -45,6 +50,53 @@ class Place(Base):
 
     bookings = relationship("Booking", back_populates="place")
     reviews = relationship("Review", back_populates="place")
+    rating = relationship("PlaceRating", uselist=False,
+                          back_populates="place", lazy="joined")
+
+    # Composite indexes keep keyset pages on /places/ an index range scan,
+    # whichever filter is applied.
+    __table_args__ = (
+        Index("ix_places_type_id", "type", "id"),
+        Index("ix_places_location_id", "location", "id"),
+        Index("ix_places_price_id", "price_per_day", "id"),
+    )
+
+
+# Search support for /places/search (see search.py). On Postgres a generated
+# tsvector column with a GIN index covers word and prefix matches and trigram
+# indexes catch misspelled names; SQLite gets an FTS5 table kept in sync by
+# triggers.
+for statement in (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE places ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(location, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'C')) STORED",
+    "CREATE INDEX ix_places_search ON places USING gin (search_vector)",
+    "CREATE INDEX ix_places_name_trgm ON places USING gin (name gin_trgm_ops)",
+    "CREATE INDEX ix_places_location_trgm ON places USING gin (location gin_trgm_ops)",
+):
+    event.listen(Place.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+for statement in (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS places_fts USING fts5("
+    "name, location, description, content='places', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER places_fts_insert AFTER INSERT ON places BEGIN "
+    "INSERT INTO places_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+    "CREATE TRIGGER places_fts_delete AFTER DELETE ON places BEGIN "
+    "INSERT INTO places_fts(places_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); END",
+    "CREATE TRIGGER places_fts_update AFTER UPDATE ON places BEGIN "
+    "INSERT INTO places_fts(places_fts, rowid, name, location, description) "
+    "VALUES ('delete', old.id, old.name, old.location, old.description); "
+    "INSERT INTO places_fts(rowid, name, location, description) "
+    "VALUES (new.id, new.name, new.location, new.description); END",
+):
+    event.listen(Place.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Place.__table__, "after_drop",
+             DDL("DROP TABLE IF EXISTS places_fts").execute_if(dialect="sqlite"))
 
 
 class Booking(Base):
@@ -55,11 +107,36 @@ class Booking(Base):
     start_date = Column(DateTime)
     end_date = Column(DateTime)
     status = Column(Enum(BookingStatus), default=BookingStatus.pending)
+    # Bumped by every state transition; writers compare-and-set on it.
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     user = relationship("User", back_populates="bookings")
     place = relationship("Place", back_populates="bookings")
     payment = relationship("Payment", uselist=False, back_populates="booking")
 
+    __mapper_args__ = {"version_id_col": version}
+    __table_args__ = (
+        Index("ix_bookings_place_end", "place_id", "end_date",
+              postgresql_where=text("status <> 'canceled'"),
+              sqlite_where=text("status <> 'canceled'")),
+    )
+
+
+# Postgres rejects overlapping live bookings of a place outright; the GiST
+# index behind the constraint also answers range-overlap lookups.
+event.listen(
+    Booking.__table__,
+    "after_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS btree_gist").execute_if(dialect="postgresql"),
+)
+event.listen(
+    Booking.__table__,
+    "after_create",
+    DDL("ALTER TABLE bookings ADD CONSTRAINT bookings_no_overlap "
+        "EXCLUDE USING gist (place_id WITH =, tsrange(start_date, end_date) WITH &&) "
+        "WHERE (status <> 'canceled')").execute_if(dialect="postgresql"),
+)
+
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -68,9 +145,18 @@ class Payment(Base):
     amount = Column(Float)
     status = Column(Enum(PaymentStatus), default=PaymentStatus.pending)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    # set when a worker claims the payment; identifies the claim
+    claimed_at = Column(DateTime)
 
     booking = relationship("Booking", back_populates="payment")
 
+    # At most one live payment per booking; a failed one can be retried.
+    __table_args__ = (
+        Index("ix_payments_booking_live", "booking_id", unique=True,
+              postgresql_where=text("status IN ('pending', 'processing', 'paid')"),
+              sqlite_where=text("status IN ('pending', 'processing', 'paid')")),
+    )
+
 
 class Review(Base):
     __tablename__ = "reviews"
@@ -84,5 +170,43 @@ class Review(Base):
     user = relationship("User", back_populates="reviews")
     place = relationship("Place", back_populates="reviews")
 
+    __table_args__ = (
+        Index("ix_reviews_place_created", "place_id", "created_at", "id"),
+    )
+
+
+class PlaceRating(Base):
+    # Running totals maintained by leave_review, so ratings never require
+    # scanning the reviews table.
+    __tablename__ = "place_ratings"
+    place_id = Column(Integer, ForeignKey("places.id"), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    stars_1 = Column(Integer, nullable=False, default=0)
+    stars_2 = Column(Integer, nullable=False, default=0)
+    stars_3 = Column(Integer, nullable=False, default=0)
+    stars_4 = Column(Integer, nullable=False, default=0)
+    stars_5 = Column(Integer, nullable=False, default=0)
+
+    place = relationship("Place", back_populates="rating")
+
+
+
+class PlaceDailyStats(Base):
+    # One row per place and night, kept current by the booking, payment and
+    # cancel paths (rollups.py), so admin reports never scan bookings or
+    # payments. Revenue of a paid booking is spread evenly over its nights.
+    __tablename__ = "place_daily_stats"
+    place_id = Column(Integer, ForeignKey("places.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    booked_nights = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+    # bookings canceled, counted on their first night
+    cancellations = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_place_daily_stats_day", "day"),
+    )
+
 
-# psql -U booking_user -d booking_db -c "SELECT * FROM reviews; SELECT * FROM payments; SELECT * FROM bookings; SELECT * FROM places; SELECT * FROM users;"
+# psql -U booking_user -d booking_db -c "SELECT * FROM reviews; SELECT * FROM payments; SELECT * FROM bookings; SELECT * FROM places; SELECT * FROM place_ratings; SELECT * FROM place_daily_stats; SELECT * FROM users;"
@@ -0,0 +1,287 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Protocol
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, select, update
+from metrics import Histogram
+import database
+import models
+import rollups
+
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", "4"))
+PAYMENT_MAX_QUEUE = int(os.getenv("PAYMENT_MAX_QUEUE", "1000"))
+PAYMENT_MAX_ATTEMPTS = int(os.getenv("PAYMENT_MAX_ATTEMPTS", "3"))
+PAYMENT_PROVIDER_TIMEOUT = float(os.getenv("PAYMENT_PROVIDER_TIMEOUT", "30"))
+PAYMENT_FAKE_LATENCY = float(os.getenv("PAYMENT_FAKE_LATENCY", "0.5"))
+PAYMENT_FAKE_FAILURE_RATE = float(os.getenv("PAYMENT_FAKE_FAILURE_RATE", "0"))
+# A claim older than this is taken to belong to a worker that died; it must
+# outlast every charge attempt (PAYMENT_MAX_ATTEMPTS x PAYMENT_PROVIDER_TIMEOUT).
+PAYMENT_CLAIM_TIMEOUT = float(os.getenv("PAYMENT_CLAIM_TIMEOUT", "300"))
+# How often each process looks for payments to (re)try: handed back after a
+# failed charge, left by a stopped process, or with a stale claim.
+PAYMENT_SWEEP_INTERVAL = float(os.getenv("PAYMENT_SWEEP_INTERVAL", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentProvider(Protocol):
+    # payment_id doubles as the idempotency key: a payment recovered after a
+    # restart may be charged again and must not be billed twice.
+
+    async def charge(self, payment_id: int, amount: float) -> bool:
+        ...
+
+    async def refund(self, payment_id: int, amount: float) -> None:
+        ...
+
+
+class FakeProvider:
+    # Stand-in for a real gateway: answers after a delay and declines a
+    # configurable share of charges.
+
+    def __init__(self, latency: float = PAYMENT_FAKE_LATENCY, failure_rate: float = PAYMENT_FAKE_FAILURE_RATE):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.charged = {}
+
+    async def charge(self, payment_id: int, amount: float):
+        await asyncio.sleep(self.latency)
+        if payment_id not in self.charged:
+            self.charged[payment_id] = random.random() >= self.failure_rate
+        return self.charged[payment_id]
+
+    async def refund(self, payment_id: int, amount: float):
+        await asyncio.sleep(self.latency)
+        self.charged.pop(payment_id, None)
+
+
+class PaymentProcessor:
+    # Charges queued payments on a few asyncio workers. Requests only insert
+    # a pending Payment and enqueue its id; no request handler or database
+    # connection waits on the provider. A worker claims the payment before
+    # charging it, so of several processes that queued the same id only one
+    # charges it. Refunds for canceled bookings go through the same queue.
+    # Payments left pending or refunding, or whose claim has gone stale, are
+    # queued again by a sweep at start() and every sweep_interval seconds.
+
+    def __init__(self, provider: PaymentProvider, workers: int, max_queue: int, sweep_interval: float):
+        self.provider = provider
+        self.workers = workers
+        self.max_queue = max_queue
+        self.sweep_interval = sweep_interval
+        self.queue = asyncio.Queue()
+        self._queued = set()
+        self.in_flight = 0
+        self.paid = 0
+        self.failed = 0
+        self.refunded = 0
+        self.errors = 0
+        self.provider_time = Histogram()
+        self._tasks = []
+        self._waiters = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._queued = set()
+        await self.sweep()
+        self._tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self.run_sweeps()))
+
+    async def stop(self):
+        # Unfinished payments stay pending in the database for the next start.
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def check_capacity(self):
+        if self.queue.qsize() >= self.max_queue:
+            raise HTTPException(
+                status_code=503, detail="Payments are busy, try again later", headers={"Retry-After": "5"})
+
+    def enqueue(self, payment_id: int):
+        if payment_id not in self._queued:
+            self._queued.add(payment_id)
+            self.queue.put_nowait(payment_id)
+
+    async def sweep(self):
+        async with database.SessionLocal() as db:
+            result = await db.execute(select(models.Payment.id).where(or_(
+                claimable(datetime.utcnow()), models.Payment.status == models.PaymentStatus.refunding,
+            )).order_by(models.Payment.id))
+            for payment_id in result.scalars():
+                self.enqueue(payment_id)
+
+    async def run_sweeps(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Payment sweep failed")
+
+    async def wait(self, payment_id: int, timeout: float):
+        # Wakes up when this process finishes the payment. A payment handled
+        # by another server process only shows up when the timeout expires.
+        # [event, number of waiters]
+        waiter = self._waiters.setdefault(payment_id, [asyncio.Event(), 0])
+        waiter[1] += 1
+        try:
+            await asyncio.wait_for(waiter[0].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter[1] -= 1
+            if not waiter[1] and self._waiters.get(payment_id) is waiter:
+                del self._waiters[payment_id]
+
+    def notify(self, payment_id: int):
+        waiter = self._waiters.pop(payment_id, None)
+        if waiter is not None:
+            waiter[0].set()
+
+    async def work(self):
+        while True:
+            payment_id = await self.queue.get()
+            self._queued.discard(payment_id)
+            self.in_flight += 1
+            try:
+                await self.process(payment_id)
+            except Exception:
+                # Outcome unknown (provider unreachable or erroring): the
+                # payment is back to pending, or still refunding, and the next
+                # sweep retries it.
+                self.errors += 1
+                logger.exception("Payment %s could not be processed", payment_id)
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+                self.notify(payment_id)
+
+    async def process(self, payment_id: int):
+        claimed_at = datetime.utcnow()
+        async with database.SessionLocal() as db:
+            result = await db.execute(update(models.Payment).where(
+                models.Payment.id == payment_id, claimable(claimed_at),
+            ).values(status=models.PaymentStatus.processing, claimed_at=claimed_at).returning(
+                models.Payment.booking_id, models.Payment.amount,
+            ).execution_options(synchronize_session=False))
+            claimed = result.first()
+            await db.commit()
+        if claimed is None:
+            # settled, canceled, being charged by another worker or to be
+            # refunded
+            await self.refund(payment_id)
+            return
+        booking_id, amount = claimed
+        ours = (
+            models.Payment.id == payment_id,
+            models.Payment.status == models.PaymentStatus.processing,
+            models.Payment.claimed_at == claimed_at,
+        )
+
+        try:
+            charged = await self.charge(payment_id, amount)
+        except Exception:
+            # Outcome unknown: hand the payment back so it is charged again
+            # (under the same idempotency key) by the next sweep.
+            async with database.SessionLocal() as db:
+                await db.execute(update(models.Payment).where(*ours).values(
+                    status=models.PaymentStatus.pending).execution_options(synchronize_session=False))
+                await db.commit()
+            raise
+
+        async with database.SessionLocal() as db:
+            booking = None
+            if charged:
+                # The booking may have been canceled while the charge ran.
+                result = await db.execute(update(models.Booking).where(
+                    models.Booking.id == booking_id,
+                    models.Booking.status == models.BookingStatus.pending,
+                ).values(status=models.BookingStatus.confirmed, version=models.Booking.version + 1).returning(
+                    models.Booking.place_id, models.Booking.start_date, models.Booking.end_date,
+                ).execution_options(synchronize_session=False))
+                booking = result.first()
+            confirmed = booking is not None
+            new_status = models.PaymentStatus.paid if confirmed else models.PaymentStatus.failed
+            result = await db.execute(update(models.Payment).where(*ours).values(status=new_status).returning(
+                models.Payment.id).execution_options(synchronize_session=False))
+            if result.first() is None:
+                # Our claim went stale and another worker took the payment
+                # over; its outcome stands.
+                await db.rollback()
+                return
+            if confirmed:
+                changes = rollups.Changes()
+                changes.paid(booking.place_id, booking.start_date, booking.end_date, amount)
+                await rollups.apply(db, changes)
+            await db.commit()
+
+        if confirmed:
+            self.paid += 1
+        else:
+            self.failed += 1
+            if charged:
+                await self.provider.refund(payment_id, amount)
+
+    async def refund(self, payment_id: int):
+        # The booking was canceled after it was paid. Refunding is idempotent
+        # under the payment id, so several processes may race here safely;
+        # on an error the payment stays refunding for the next sweep.
+        async with database.SessionLocal() as db:
+            amount = (await db.execute(select(models.Payment.amount).where(
+                models.Payment.id == payment_id,
+                models.Payment.status == models.PaymentStatus.refunding,
+            ))).scalar()
+        if amount is None:
+            return
+        await asyncio.wait_for(self.provider.refund(payment_id, amount), PAYMENT_PROVIDER_TIMEOUT)
+        async with database.SessionLocal() as db:
+            await db.execute(update(models.Payment).where(
+                models.Payment.id == payment_id,
+                models.Payment.status == models.PaymentStatus.refunding,
+            ).values(status=models.PaymentStatus.refunded).execution_options(synchronize_session=False))
+            await db.commit()
+        self.refunded += 1
+
+    async def charge(self, payment_id: int, amount: float):
+        for attempt in range(PAYMENT_MAX_ATTEMPTS):
+            started = time.perf_counter()
+            try:
+                return await asyncio.wait_for(
+                    self.provider.charge(payment_id, amount), PAYMENT_PROVIDER_TIMEOUT)
+            except (asyncio.TimeoutError, OSError):
+                if attempt == PAYMENT_MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+            finally:
+                self.provider_time.observe(time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self.queue.qsize(),
+            "max_queue": self.max_queue,
+            "sweep_interval": self.sweep_interval,
+            "in_flight": self.in_flight,
+            "paid": self.paid,
+            "failed": self.failed,
+            "refunded": self.refunded,
+            "errors": self.errors,
+            "provider_seconds": self.provider_time.snapshot(),
+        }
+
+
+def claimable(now: datetime):
+    return or_(
+        models.Payment.status == models.PaymentStatus.pending,
+        and_(models.Payment.status == models.PaymentStatus.processing,
+             models.Payment.claimed_at < now - timedelta(seconds=PAYMENT_CLAIM_TIMEOUT)),
+    )
+
+
+processor = PaymentProcessor(FakeProvider(), PAYMENT_WORKERS, PAYMENT_MAX_QUEUE, PAYMENT_SWEEP_INTERVAL)
@@ -0,0 +1,209 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import Depends, HTTPException, Request
+from settings import env_flag
+import auth
+
+RATE_LIMIT_ENABLED = env_flag("RATE_LIMIT_ENABLED", "true")
+RATE_LIMIT_STORE_SIZE = int(os.getenv("RATE_LIMIT_STORE_SIZE", "100000"))
+# Share the buckets between server workers; without it every worker
+# enforces the limits on its own.
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Number of reverse proxies in front of the app. Each appends the address it
+# received the request from to RATE_LIMIT_CLIENT_IP_HEADER, so the client's
+# address is the one that many entries from the right; anything further left
+# was sent by the client and can be forged.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+RATE_LIMIT_CLIENT_IP_HEADER = os.getenv("RATE_LIMIT_CLIENT_IP_HEADER", "x-forwarded-for")
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Limit:
+    # Up to `burst` requests at once, refilled at burst/period per second.
+    burst: int
+    period: float
+
+    @property
+    def rate(self):
+        return self.burst / self.period
+
+    @classmethod
+    def parse(cls, spec: str):
+        # "20/60" is 20 requests per 60 seconds; "off" disables the limit.
+        if spec.strip().lower() == "off":
+            return None
+        burst, period = spec.split("/")
+        return cls(int(burst), float(period))
+
+
+def env_limit(name: str, default: str):
+    return Limit.parse(os.getenv(name, default))
+
+
+class MemoryStore:
+    # key -> (tokens, updated, full_at), least recently used first. A bucket
+    # left alone until it is full again is the same as no bucket, so idle
+    # keys are dropped from the front as requests come in, and maxsize caps
+    # memory under a flood of distinct keys. Everything is O(1) amortized.
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.evicted = 0
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, limit: Limit):
+        # Returns 0 when a token was taken, otherwise the seconds until one
+        # is available.
+        now = time.monotonic()
+        while self._buckets:
+            oldest = next(iter(self._buckets))
+            if self._buckets[oldest][2] > now:
+                break
+            del self._buckets[oldest]
+
+        bucket = self._buckets.pop(key, None)
+        tokens = limit.burst if bucket is None else min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / limit.rate
+        self._buckets[key] = (tokens, now, now + (limit.burst - tokens) / limit.rate)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+        return wait
+
+    def stats(self):
+        return {"backend": "memory", "keys": len(self._buckets), "maxsize": self.maxsize, "evicted": self.evicted}
+
+
+# Same algorithm as MemoryStore.take, atomic in Redis. Keys expire once the
+# bucket would be full again.
+TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = burst
+if state[1] then
+    tokens = math.min(burst, tonumber(state[1]) + math.max(0, now - tonumber(state[2])) * rate)
+end
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1)
+return tostring(wait)
+"""
+
+
+class RedisStore:
+
+    def __init__(self, url: str, prefix: str = "rate-limit:"):
+        import redis.asyncio
+        self._client = redis.asyncio.Redis.from_url(url)
+        self._take = self._client.register_script(TAKE_SCRIPT)
+        self._prefix = prefix
+
+    async def take(self, key: str, limit: Limit):
+        return float(await self._take(keys=[self._prefix + key], args=[limit.burst, limit.rate, time.time()]))
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+class RateLimiter:
+
+    def __init__(self, store, enabled: bool = True):
+        self.store = store
+        self.enabled = enabled
+        self.allowed = 0
+        self.throttled = defaultdict(int)
+        self.errors = 0
+
+    async def check(self, rule: str, key: Optional[str], limit: Optional[Limit]):
+        if not self.enabled or limit is None or key is None:
+            return
+        try:
+            wait = await self.store.take(f"{rule}:{key}", limit)
+        except Exception:
+            # An unreachable shared store must not take the API down with it.
+            self.errors += 1
+            logger.exception("Rate limit check failed")
+            return
+        if wait > 0:
+            self.throttled[rule] += 1
+            raise HTTPException(status_code=429, detail="Too many requests, try again later",
+                                headers={"Retry-After": str(math.ceil(wait))})
+        self.allowed += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "allowed": self.allowed,
+            "throttled": dict(self.throttled),
+            "errors": self.errors,
+            "store": self.store.stats(),
+        }
+
+
+def client_ip(request: Request):
+    if RATE_LIMIT_TRUSTED_PROXIES:
+        forwarded = [address.strip() for address in request.headers.get(RATE_LIMIT_CLIENT_IP_HEADER, "").split(",")]
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES and forwarded[-RATE_LIMIT_TRUSTED_PROXIES]:
+            return forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    return request.client.host if request.client else None
+
+
+# Sources of the per-user key. Each route names its own, so a header the
+# route does not use (say, a junk bearer token on /login/) cannot switch
+# the key off.
+
+async def token_username(request: Request):
+    # The token's subject, checked without touching the database.
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return auth.token_subject(token)
+
+
+async def body_username(request: Request):
+    # The username being tried on /login/.
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    username = body.get("username") if isinstance(body, dict) else None
+    return username if isinstance(username, str) else None
+
+
+def rate_limit(name: str, per_ip: Optional[Limit] = None, per_user: Optional[Limit] = None, user_key=None):
+    # Route dependency. Listed in the decorator's dependencies it runs before
+    # the handler's own ones, so a throttled request never reaches the
+    # database or the password hasher.
+    if per_user is not None and user_key is None:
+        raise ValueError(f"Rate limit {name} needs a user_key for its per-user limit")
+
+    async def check(request: Request):
+        await limiter.check(f"{name}:ip", client_ip(request), per_ip)
+        if per_user is not None:
+            await limiter.check(f"{name}:user", await user_key(request), per_user)
+
+    return Depends(check)
+
+
+limiter = RateLimiter(
+    RedisStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryStore(RATE_LIMIT_STORE_SIZE),
+    enabled=RATE_LIMIT_ENABLED,
+)
@@ -0,0 +1,56 @@
+from collections import Counter
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import database
+import models
+
+STARS = (1, 2, 3, 4, 5)
+COUNTER_COLUMNS = ("count", "rating_sum") + tuple(f"stars_{stars}" for stars in STARS)
+
+
+async def record_ratings(db: AsyncSession, place_id: int, ratings):
+    # Folds new ratings into the aggregate row in the caller's transaction,
+    # creating the row on the first review of a place.
+    await record_batch(db, {place_id: ratings})
+
+
+async def record_batch(db: AsyncSession, ratings_by_place):
+    # One multi-row upsert for several places. Each place appears once:
+    # Postgres refuses to update the same row twice in one statement.
+    rows = []
+    for place_id, ratings in ratings_by_place.items():
+        histogram = Counter(ratings)
+        values = {"place_id": place_id, "count": len(ratings), "rating_sum": sum(ratings)}
+        values.update({f"stars_{stars}": histogram[stars] for stars in STARS})
+        rows.append(values)
+
+    stmt = database.upsert(db, models.PlaceRating).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.PlaceRating.place_id],
+        set_={column: getattr(models.PlaceRating, column) + stmt.excluded[column]
+              for column in COUNTER_COLUMNS},
+    )
+    await db.execute(stmt)
+
+
+async def rebuild(db: AsyncSession):
+    # Recomputes every aggregate from the reviews table in one INSERT ... SELECT.
+    totals = select(
+        models.Review.place_id,
+        func.count(),
+        func.sum(models.Review.rating),
+        *[func.sum(case((models.Review.rating == stars, 1), else_=0)) for stars in STARS],
+    ).group_by(models.Review.place_id)
+    await db.execute(delete(models.PlaceRating))
+    await db.execute(insert(models.PlaceRating).from_select(
+        ("place_id",) + COUNTER_COLUMNS, totals))
+
+
+def summary(rating: models.PlaceRating):
+    if rating is None or not rating.count:
+        return {"count": 0, "average": None, "histogram": {str(stars): 0 for stars in STARS}}
+    return {
+        "count": rating.count,
+        "average": round(rating.rating_sum / rating.count, 2),
+        "histogram": {str(stars): getattr(rating, f"stars_{stars}") for stars in STARS},
+    }
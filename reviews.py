@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from metrics import Histogram
+import cache
+import database
+import models
+import ratings
+
+# sync:     every review is committed in its own request (no buffering)
+# group:    requests wait for the batch their review is committed in, so a
+#           200 still means the review is on disk
+# buffered: requests return 202 at once; reviews not yet flushed are lost
+#           if the process dies
+REVIEW_DURABILITY = os.getenv("REVIEW_DURABILITY", "sync")
+REVIEW_BATCH_SIZE = int(os.getenv("REVIEW_BATCH_SIZE", "500"))
+REVIEW_FLUSH_INTERVAL = float(os.getenv("REVIEW_FLUSH_INTERVAL", "0.05"))
+REVIEW_MAX_PENDING = int(os.getenv("REVIEW_MAX_PENDING", "10000"))
+
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+logger = logging.getLogger(__name__)
+
+
+class ReviewBuffer:
+    # Collects reviews and writes them REVIEW_BATCH_SIZE at a time, every
+    # REVIEW_FLUSH_INTERVAL seconds or as soon as a batch fills up: one
+    # multi-row INSERT, one rating upsert and one commit per batch.
+
+    def __init__(self, mode: str, batch_size: int, interval: float, max_pending: int):
+        if mode not in ("sync", "group", "buffered"):
+            raise ValueError(f"Unknown review durability mode: {mode}")
+        self.mode = mode
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = []
+        self.written = 0
+        self.failed = 0
+        self.batch_sizes = Histogram(BATCH_BUCKETS)
+        self.flush_time = Histogram()
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    @property
+    def buffered(self):
+        return self.mode != "sync"
+
+    async def start(self):
+        if self.buffered:
+            self._wake = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Holding the lock lets a flush in progress finish first.
+            async with self._flush_lock:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def add(self, row: dict):
+        if len(self.pending) >= self.max_pending:
+            raise HTTPException(
+                status_code=503, detail="Too many reviews, try again later", headers={"Retry-After": "1"})
+        future = asyncio.get_running_loop().create_future() if self.mode == "group" else None
+        self.pending.append((row, future))
+        if len(self.pending) >= self.batch_size:
+            self._wake.set()
+        if future is not None:
+            await future
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Review flush failed")
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self.pending:
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                started = time.perf_counter()
+                try:
+                    await write([row for row, _ in batch])
+                    results = [None] * len(batch)
+                except IntegrityError:
+                    # A bad row (say, an unknown place) must not sink the
+                    # rest of the batch: retry the rows one by one.
+                    results = []
+                    for row, _ in batch:
+                        try:
+                            await write([row])
+                            results.append(None)
+                        except IntegrityError as error:
+                            results.append(error)
+                except Exception as error:
+                    results = [error] * len(batch)
+                self.flush_time.observe(time.perf_counter() - started)
+                self.batch_sizes.observe(len(batch))
+
+                written_places = {row["place_id"] for (row, _), error in zip(batch, results) if error is None}
+                if written_places:
+                    try:
+                        await cache.place_cache.invalidate(
+                            "places", *[f"place:{place_id}" for place_id in written_places])
+                    except Exception:
+                        logger.exception("Place cache invalidation failed")
+
+                for (row, future), error in zip(batch, results):
+                    if error is None:
+                        self.written += 1
+                    else:
+                        self.failed += 1
+                        if future is None:
+                            logger.error("Dropped buffered review for place %s: %s", row["place_id"], error)
+                    if future is not None and not future.done():
+                        if error is None:
+                            future.set_result(None)
+                        else:
+                            future.set_exception(HTTPException(status_code=503, detail="Review could not be saved"))
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "pending": len(self.pending),
+            "batch_size": self.batch_size,
+            "interval": self.interval,
+            "written": self.written,
+            "failed": self.failed,
+            "batch_sizes": self.batch_sizes.snapshot(),
+            "flush_seconds": self.flush_time.snapshot(),
+        }
+
+
+async def write(rows):
+    ratings_by_place = defaultdict(list)
+    for row in rows:
+        ratings_by_place[row["place_id"]].append(row["rating"])
+    async with database.SessionLocal() as db:
+        await db.execute(insert(models.Review).values(rows))
+        await ratings.record_batch(db, ratings_by_place)
+        await db.commit()
+
+
+review_buffer = ReviewBuffer(REVIEW_DURABILITY, REVIEW_BATCH_SIZE, REVIEW_FLUSH_INTERVAL, REVIEW_MAX_PENDING)
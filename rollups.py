@@ -0,0 +1,95 @@
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import database
+import models
+
+COUNTER_COLUMNS = ("booked_nights", "revenue", "cancellations")
+REBUILD_BATCH_SIZE = 5000
+
+
+def nights(start: datetime, end: datetime):
+    day = start.date()
+    while day < end.date():
+        yield day
+        day += timedelta(days=1)
+
+
+class Changes:
+    # Accumulates counter deltas per (place, day) so a request, a batch or
+    # a rebuild writes them with one multi-row upsert.
+
+    def __init__(self):
+        self.rows = defaultdict(lambda: dict.fromkeys(COUNTER_COLUMNS, 0))
+
+    def booked(self, place_id: int, start: datetime, end: datetime, sign: int = 1):
+        for day in nights(start, end):
+            self.rows[place_id, day]["booked_nights"] += sign
+
+    def paid(self, place_id: int, start: datetime, end: datetime, amount: float, sign: int = 1):
+        days = list(nights(start, end))
+        for day in days:
+            self.rows[place_id, day]["revenue"] += sign * amount / len(days)
+
+    def canceled(self, place_id: int, start: datetime):
+        self.rows[place_id, start.date()]["cancellations"] += 1
+
+    def values(self):
+        return [{"place_id": place_id, "day": day, **counters}
+                for (place_id, day), counters in self.rows.items()]
+
+
+async def apply(db: AsyncSession, changes: Changes):
+    # Adds the deltas in the caller's transaction, creating missing rows.
+    rows = changes.values()
+    if not rows:
+        return
+    stmt = database.upsert(db, models.PlaceDailyStats).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.PlaceDailyStats.place_id, models.PlaceDailyStats.day],
+        set_={column: getattr(models.PlaceDailyStats, column) + stmt.excluded[column]
+              for column in COUNTER_COLUMNS},
+    )
+    await db.execute(stmt)
+
+
+async def rebuild(db: AsyncSession):
+    # Recomputes every row from bookings and paid payments. Bookings are
+    # streamed, so memory grows with the number of place-nights, not with
+    # the bookings table.
+    paid = select(models.Payment.booking_id, func.sum(models.Payment.amount).label("amount")).where(
+        models.Payment.status == models.PaymentStatus.paid).group_by(models.Payment.booking_id).subquery()
+    query = select(
+        models.Booking.place_id, models.Booking.start_date, models.Booking.end_date,
+        models.Booking.status, paid.c.amount,
+    ).outerjoin(paid, paid.c.booking_id == models.Booking.id).execution_options(yield_per=REBUILD_BATCH_SIZE)
+
+    changes = Changes()
+    result = await db.stream(query)
+    async for place_id, start, end, status, amount in result:
+        if status == models.BookingStatus.canceled:
+            changes.canceled(place_id, start)
+            continue
+        changes.booked(place_id, start, end)
+        if amount:
+            changes.paid(place_id, start, end, amount)
+
+    await db.execute(delete(models.PlaceDailyStats))
+    rows = changes.values()
+    for offset in range(0, len(rows), REBUILD_BATCH_SIZE):
+        await db.execute(insert(models.PlaceDailyStats), rows[offset:offset + REBUILD_BATCH_SIZE])
+
+
+async def report(db: AsyncSession, date_from: date, date_to: date, place_id: int = None):
+    # Per-place totals over [date_from, date_to).
+    query = select(
+        models.PlaceDailyStats.place_id,
+        *[func.sum(getattr(models.PlaceDailyStats, column)).label(column) for column in COUNTER_COLUMNS],
+    ).where(
+        models.PlaceDailyStats.day >= date_from,
+        models.PlaceDailyStats.day < date_to,
+    ).group_by(models.PlaceDailyStats.place_id).order_by(models.PlaceDailyStats.place_id)
+    if place_id is not None:
+        query = query.where(models.PlaceDailyStats.place_id == place_id)
+    return (await db.execute(query)).all()
@@ -0,0 +1,50 @@
+import re
+from sqlalchemy import column, func, literal_column, or_, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+
+# Longer queries are cut to their first words; each word is matched as a
+# prefix, all words must match.
+SEARCH_MAX_TERMS = 8
+
+places_fts = table("places_fts", column("rowid"))
+search_vector = literal_column("places.search_vector")
+
+
+def search_terms(q: str):
+    return re.findall(r"\w+", q.lower())[:SEARCH_MAX_TERMS]
+
+
+def postgres_query(terms):
+    # Ranked by text relevance plus name similarity, so a close misspelling
+    # that only the trigram index found still sorts below exact hits.
+    phrase = " ".join(terms)
+    tsquery = func.to_tsquery("simple", " & ".join(f"{term}:*" for term in terms))
+    # similarity() is NULL for a place without a name, and DESC puts NULLs first
+    rank = func.ts_rank(search_vector, tsquery) + func.coalesce(func.similarity(models.Place.name, phrase), 0)
+    return select(models.Place).where(or_(
+        search_vector.op("@@")(tsquery),
+        models.Place.name.op("%")(phrase),
+        models.Place.location.op("%")(phrase),
+    )).order_by(rank.desc(), models.Place.id)
+
+
+def sqlite_query(terms):
+    # FTS5 fallback: prefix matching and bm25 ranking, weighted like the
+    # tsvector (name over location over description), but no typo tolerance.
+    match = " ".join(f'"{term}"*' for term in terms)
+    rank = func.bm25(literal_column("places_fts"), 10.0, 5.0, 1.0)
+    return select(models.Place).join(places_fts, places_fts.c.rowid == models.Place.id).where(
+        literal_column("places_fts").op("MATCH")(match)).order_by(rank, models.Place.id)
+
+
+async def search_places(db: AsyncSession, q: str, limit: int, offset: int):
+    terms = search_terms(q)
+    if not terms:
+        return []
+    if db.get_bind().dialect.name == "postgresql":
+        query = postgres_query(terms)
+    else:
+        query = sqlite_query(terms)
+    result = await db.execute(query.limit(limit).offset(offset))
+    return result.scalars().all()
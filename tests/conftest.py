@@ -0,0 +1,52 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import auth
+import database
+import main
+import models
+import payments
+import ratelimit
+from settings import Settings
+
+PASSWORD = "secret"
+
+
+async def seed():
+    async with database.SessionLocal() as db:
+        password_hash = auth.hash_password(PASSWORD)
+        db.add_all([
+            models.User(username="alice", email="alice@example.com", password_hash=password_hash),
+            models.Place(name="Flat", type="flat", location="Sofia", description="", price_per_day=50),
+            models.Place(name="House", type="house", location="Varna", description="", price_per_day=80),
+        ])
+        await db.commit()
+
+
+@pytest.fixture
+def database_url():
+    # one shared connection; tests running the payment workers alongside
+    # requests override this with a file database
+    return "sqlite+aiosqlite:///:memory:"
+
+
+@pytest.fixture
+def client(monkeypatch, database_url):
+    # fresh buckets for every test
+    monkeypatch.setattr(ratelimit.limiter, "store", ratelimit.MemoryStore(1000))
+    app = main.create_app(Settings(database_url=database_url, secret_key="test"))
+    with TestClient(app) as client:
+        # /pay/ only queues the payment; nothing is charged in the background
+        client.portal.call(payments.processor.stop)
+        client.portal.call(seed)
+        yield client
+
+
+def login(client, username="alice"):
+    token = client.post("/login/", json={"username": username, "password": PASSWORD}).json()["access_token"]
+    client.headers["Authorization"] = f"Bearer {token}"
@@ -0,0 +1,65 @@
+from conftest import login
+
+
+def test_availability_accepts_aware_datetimes(client):
+    login(client)
+    client.post("/book/", json={"place_id": 1, "start_date": "2030-01-02T00:00:00+03:00",
+                                "end_date": "2030-01-04T00:00:00Z"})
+    response = client.get("/places/1/availability",
+                          params={"from": "2029-12-30T00:00:00Z", "to": "2030-01-10T00:00:00Z"})
+    assert response.status_code == 200
+    assert response.json()["free"] == [
+        {"start": "2029-12-30T00:00:00", "end": "2030-01-01T21:00:00"},
+        {"start": "2030-01-04T00:00:00", "end": "2030-01-10T00:00:00"},
+    ]
+
+
+def test_booking_stores_naive_utc(client):
+    login(client)
+    response = client.post("/book/", json={"place_id": 1, "start_date": "2030-02-01T12:00:00+02:00",
+                                           "end_date": "2030-02-03T12:00:00+02:00"})
+    assert response.status_code == 200
+    booking = client.get("/my_bookings/").json()[0]
+    assert booking["start_date"] == "2030-02-01T10:00:00"
+    # the same period given in UTC clashes with it
+    response = client.post("/book/", json={"place_id": 1, "start_date": "2030-02-02T00:00:00Z",
+                                           "end_date": "2030-02-02T06:00:00Z"})
+    assert response.status_code == 409
+
+
+def test_batch_accepts_aware_datetimes(client):
+    login(client)
+    client.post("/book/", json={"place_id": 1, "start_date": "2030-03-01", "end_date": "2030-03-03"})
+    response = client.post("/book/batch", json={"atomic": False, "items": [
+        {"place_id": 1, "start_date": "2030-03-02T00:00:00Z", "end_date": "2030-03-04T00:00:00Z"},
+        {"place_id": 2, "start_date": "2030-03-02T00:00:00+03:00", "end_date": "2030-03-04T00:00:00+03:00"},
+    ]})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert results[0] == {"index": 0, "error": "Place is already booked for these dates"}
+    assert "booking_id" in results[1]
+
+
+def test_batch_rechecks_after_concurrent_clash(client, monkeypatch):
+    # Stands in for a single /book/ that commits a clashing booking between
+    # the batch's check and its insert (the exclusion constraint on Postgres).
+    import rollups
+    from sqlalchemy.exc import IntegrityError
+
+    login(client)
+    apply = rollups.apply
+    calls = []
+
+    async def clash_once(db, changes):
+        calls.append(1)
+        if len(calls) == 1:
+            raise IntegrityError("INSERT INTO bookings", {}, Exception("bookings_no_overlap"))
+        await apply(db, changes)
+
+    monkeypatch.setattr(rollups, "apply", clash_once)
+    response = client.post("/book/batch", json={"atomic": False, "items": [
+        {"place_id": 1, "start_date": "2030-04-01", "end_date": "2030-04-03"},
+    ]})
+    assert response.status_code == 200
+    assert "booking_id" in response.json()["results"][0]
+    assert len(calls) == 2
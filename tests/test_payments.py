@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+import payments
+from conftest import login
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite+aiosqlite:///{tmp_path}/test.db"
+
+
+class FlakyProvider(payments.FakeProvider):
+    # unreachable on the first charge, fine afterwards
+
+    def __init__(self):
+        super().__init__(latency=0, failure_rate=0)
+        self.attempts = 0
+
+    async def charge(self, payment_id, amount):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise OSError("connection reset")
+        return await super().charge(payment_id, amount)
+
+
+def pay(client):
+    booking = client.post("/book/", json={"place_id": 1, "start_date": "2030-01-01", "end_date": "2030-01-03"})
+    response = client.post("/pay/", json={"booking_id": booking.json()["booking_id"], "amount": 100})
+    assert response.status_code == 202
+    return response.json()["payment_id"]
+
+
+def settle(client, payment_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        payment = client.get(f"/payments/{payment_id}", params={"wait": 1}).json()
+        if payment["status"] not in ("pending", "processing", "refunding") or time.monotonic() > deadline:
+            return payment
+
+
+def test_transient_provider_failure_is_retried(client, monkeypatch):
+    provider = FlakyProvider()
+    monkeypatch.setattr(payments, "PAYMENT_MAX_ATTEMPTS", 1)
+    monkeypatch.setattr(payments.processor, "provider", provider)
+    monkeypatch.setattr(payments.processor, "sweep_interval", 0.1)
+    client.portal.call(payments.processor.start)
+    login(client)
+
+    payment_id = pay(client)
+    assert settle(client, payment_id)["status"] == "paid"
+    assert provider.attempts == 2
+    assert payments.processor.errors >= 1
+
+
+def test_cancel_refunds_paid_booking(client, monkeypatch):
+    provider = payments.FakeProvider(latency=0, failure_rate=0)
+    refunds = []
+    refund = provider.refund
+
+    async def record_refund(payment_id, amount):
+        refunds.append((payment_id, amount))
+        await refund(payment_id, amount)
+
+    monkeypatch.setattr(provider, "refund", record_refund)
+    monkeypatch.setattr(payments.processor, "provider", provider)
+    client.portal.call(payments.processor.start)
+    login(client)
+
+    payment_id = pay(client)
+    assert settle(client, payment_id)["status"] == "paid"
+    booking = client.get("/my_bookings/").json()[0]
+    assert client.post(f"/cancel_booking/{booking['id']}").status_code == 200
+
+    payment = settle(client, payment_id)
+    assert payment["status"] == "refunded"
+    assert refunds == [(payment_id, 100)]
+    assert payment_id not in provider.charged
+
+
+def test_cancel_fails_pending_payment(client):
+    # the processor is stopped, so the payment is still pending
+    login(client)
+    payment_id = pay(client)
+    booking = client.get("/my_bookings/").json()[0]
+    assert client.post(f"/cancel_booking/{booking['id']}").status_code == 200
+    assert client.get(f"/payments/{payment_id}").json()["status"] == "failed"
@@ -0,0 +1,78 @@
+# Each write route runs a fixed number of SQL statements. The counts are
+# pinned to QUERY_BUDGETS, which include the user lookup on a cold auth
+# cache, so a route that grows a statement fails here.
+import pytest
+
+import auth
+import main
+import metrics
+import ratelimit
+from conftest import PASSWORD, login
+
+
+@pytest.fixture(autouse=True)
+def logged_in(client, monkeypatch):
+    monkeypatch.setattr(ratelimit.limiter, "enabled", False)
+    login(client)
+
+
+def call(client, method, route, url=None, **kwargs):
+    auth.user_cache.clear()
+    budget = main.QUERY_BUDGETS[method, route]
+    with metrics.query_budget(budget, f"{method} {route}") as stats:
+        response = client.request(method, url or route, **kwargs)
+    assert stats.queries == budget, f"{method} {route} ran {stats.queries} statements, budget is {budget}"
+    return response
+
+
+def book(client, place_id=1, start="2030-01-01", end="2030-01-05"):
+    return call(client, "POST", "/book/", json={"place_id": place_id, "start_date": start, "end_date": end})
+
+
+def test_register(client):
+    response = call(client, "POST", "/register/",
+                    json={"username": "bob", "email": "bob@example.com", "password": PASSWORD})
+    assert response.status_code == 201
+
+
+def test_login(client):
+    response = call(client, "POST", "/login/", json={"username": "alice", "password": PASSWORD})
+    assert response.status_code == 200
+
+
+def test_book(client):
+    assert book(client).status_code == 200
+
+
+def test_book_taken(client):
+    book(client)
+    assert book(client, start="2030-01-03", end="2030-01-07").status_code == 409
+
+
+def test_book_missing_place(client):
+    assert book(client, place_id=99).status_code == 404
+
+
+def test_pay(client):
+    booking_id = book(client).json()["booking_id"]
+    response = call(client, "POST", "/pay/", json={"booking_id": booking_id, "amount": 200})
+    assert response.status_code == 202
+
+
+def test_pay_twice(client):
+    booking_id = book(client).json()["booking_id"]
+    call(client, "POST", "/pay/", json={"booking_id": booking_id, "amount": 200})
+    response = call(client, "POST", "/pay/", json={"booking_id": booking_id, "amount": 200})
+    assert response.status_code == 409
+
+
+def test_cancel(client):
+    booking_id = book(client).json()["booking_id"]
+    call(client, "POST", "/pay/", json={"booking_id": booking_id, "amount": 200})
+    response = call(client, "POST", "/cancel_booking/{booking_id}", f"/cancel_booking/{booking_id}")
+    assert response.status_code == 200
+
+
+def test_review(client):
+    response = call(client, "POST", "/review/", json={"place_id": 1, "rating": 5, "comment": "Great"})
+    assert response.status_code == 200
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import main
+import ratelimit
+from conftest import PASSWORD, login
+
+
+def bad_logins(client, count, **kwargs):
+    return [client.post("/login/", json={"username": "alice", "password": "wrong"}, **kwargs).status_code
+            for _ in range(count)]
+
+
+def test_login_throttled_per_username(client):
+    burst = main.LOGIN_USER_LIMIT.burst
+    assert bad_logins(client, burst + 2) == [401] * burst + [429, 429]
+
+
+def test_junk_bearer_token_does_not_skip_login_limit(client):
+    burst = main.LOGIN_USER_LIMIT.burst
+    codes = bad_logins(client, burst + 2, headers={"Authorization": "Bearer junk"})
+    assert codes == [401] * burst + [429, 429]
+
+
+def test_throttled_login_has_retry_after(client):
+    bad_logins(client, main.LOGIN_USER_LIMIT.burst)
+    response = client.post("/login/", json={"username": "alice", "password": PASSWORD})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+
+def test_write_routes_throttled_per_user(client):
+    login(client)
+    burst = main.WRITE_USER_LIMIT.burst
+    codes = [client.post("/cancel_booking/999").status_code for _ in range(burst + 1)]
+    assert codes == [404] * burst + [429]
+
+
+def request_from(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 1234)})
+
+
+@pytest.mark.parametrize("proxies, forwarded, expected", [
+    (0, "6.6.6.6", "10.0.0.9"),
+    (1, "6.6.6.6, 192.0.2.7", "192.0.2.7"),
+    (2, "6.6.6.6, 192.0.2.7, 10.0.0.1", "192.0.2.7"),
+    (2, "192.0.2.7", "10.0.0.9"),
+    (1, None, "10.0.0.9"),
+])
+def test_client_ip_ignores_client_supplied_entries(monkeypatch, proxies, forwarded, expected):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", proxies)
+    assert ratelimit.client_ip(request_from("10.0.0.9", forwarded)) == expected
+
+
+def test_forged_forwarded_for_does_not_rotate_ip_key(client, monkeypatch):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", 1)
+    burst = main.REGISTER_IP_LIMIT.burst
+    codes = [client.post("/register/", json={"username": f"u{i}", "email": f"u{i}", "password": "x"},
+                         headers={"X-Forwarded-For": f"6.6.6.{i}, 192.0.2.7"}).status_code
+             for i in range(burst + 1)]
+    assert codes == [201] * burst + [429]
+
+
+def test_memory_store_is_bounded():
+    store = ratelimit.MemoryStore(3)
+    limit = ratelimit.Limit(1, 60)
+
+    async def take_all():
+        return [await store.take(key, limit) for key in "abcdea"]
+
+    waits = asyncio.run(take_all())
+    assert waits == [0] * 6  # "a" was evicted, so it starts with a full bucket again
+    assert store.stats()["keys"] == 3
@@ -0,0 +1,28 @@
+from sqlalchemy import delete, insert
+
+import database
+import models
+from conftest import login
+
+
+async def make_admin_and_legacy_reviews():
+    # reviews written before place_ratings existed: no aggregate rows
+    async with database.SessionLocal() as db:
+        db.add(models.User(username="root", email="root@example.com", role=models.UserRole.admin,
+                           password_hash=(await db.get(models.User, 1)).password_hash))
+        await db.execute(insert(models.Review), [
+            {"user_id": 1, "place_id": 1, "rating": 5, "comment": ""},
+            {"user_id": 1, "place_id": 1, "rating": 3, "comment": ""},
+        ])
+        await db.execute(delete(models.PlaceRating))
+        await db.commit()
+
+
+def test_rebuild_backfills_ratings(client):
+    client.portal.call(make_admin_and_legacy_reviews)
+    assert client.get("/places/1").json()["rating"]["count"] == 0
+
+    login(client, "root")
+    assert client.post("/admin/stats/rebuild").status_code == 200
+    rating = client.get("/places/1").json()["rating"]
+    assert (rating["count"], rating["average"]) == (2, 4.0)